@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""
+benchmark - Measures check_solace against a local fake SEMP server
+"""
+
+import BaseHTTPServer
+import SocketServer
+import getopt
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from check_solace import CHECK_MODES
+
+CHECK_SOLACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_solace.py")
+
+GLOBAL_STATS_TAGS = ['total-client-messages-received', 'total-client-messages-sent',
+                     'client-data-messages-received', 'client-data-messages-sent',
+                     'client-persistent-messages-received', 'client-persistent-messages-sent',
+                     'client-non-persistent-messages-received', 'client-non-persistent-messages-sent',
+                     'client-direct-messages-received', 'client-direct-messages-sent',
+                     'client-control-messages-received', 'client-control-messages-sent',
+                     'average-ingress-rate-per-minute', 'average-egress-rate-per-minute',
+                     'total-client-bytes-received', 'total-client-bytes-sent',
+                     'client-data-bytes-received', 'client-data-bytes-sent',
+                     'client-persistent-bytes-received', 'client-persistent-bytes-sent',
+                     'client-non-persistent-bytes-received', 'client-non-persistent-bytes-sent',
+                     'client-direct-bytes-received', 'client-direct-bytes-sent',
+                     'client-control-bytes-received', 'client-control-bytes-sent',
+                     'average-ingress-byte-rate-per-minute', 'average-egress-byte-rate-per-minute',
+                     'total-ingress-discards', 'total-egress-discards']
+DETAIL_TAGS = ['no-subscription-match', 'msg-spool-discards', 'message-spool-congestion',
+               'transmit-congestion', 'compression-congestion', 'msg-spool-egress-discards']
+QUEUE_TAGS = ['num-messages-spooled', 'current-spool-usage-in-mb', 'bind-count']
+CLIENT_STATS_TAGS = ['total-client-messages-received', 'total-client-messages-sent',
+                     'total-client-bytes-received', 'total-client-bytes-sent',
+                     'total-ingress-discards', 'total-egress-discards']
+
+
+def parse_options():
+    global CLIENT_COUNTS
+    global PAGE_SIZE
+    global LATENCY
+    global REPEAT
+    global MODES
+    global OUTPUT
+    global BASELINE
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:s:l:r:m:o:b:", ['help'])
+    except getopt.GetoptError:
+        sys.stderr.write(display_help())
+        sys.exit(3)
+
+    if len(args):
+        sys.stderr.write("Unknown arguments: %s\n" % args)
+        sys.exit(3)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stdout.write(display_help())
+            sys.exit(0)
+        try:
+            if o in ('-n',):
+                CLIENT_COUNTS = [int(count) for count in a.split(',')]
+            if o in ('-s',):
+                PAGE_SIZE = int(a)
+            if o in ('-l',):
+                LATENCY = float(a) / 1000
+            if o in ('-r',):
+                REPEAT = int(a)
+            if o in ('-m',):
+                MODES = a.split(',')
+            if o in ('-o',):
+                OUTPUT = a
+            if o in ('-b',):
+                BASELINE = a
+        except ValueError:
+            sys.stderr.write(display_help())
+            sys.exit(3)
+
+
+def display_help():
+    help_msg = 'benchmark - measures check_solace against a local fake SEMP server\n\nUsage: benchmark [OPTION]...\n' \
+               '\n' \
+               '  -h, -help                            Show this help\n' \
+               '  -n <count>[,<count>...]              Client counts to generate replies for (default 10,1000,100000)\n' \
+               '  -s <clients>                         Clients per reply page, 0 for no paging (default 0)\n' \
+               '  -l <milliseconds>                    Fake router latency before each reply (default 0)\n' \
+               '  -r <runs>                            Runs per mode and client count, best is kept (default 3)\n' \
+               '  -m <mode>[,<mode>...]                check_solace modes to run (default all)\n' \
+               '  -o <file>                            Write the results as JSON to this file\n' \
+               '  -b <file>                            Compare the results with an earlier -o file\n\n'
+
+    return help_msg
+
+
+class FakeSempHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        message = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in semp_reply(message, server.clients, server.page_size):
+            self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write("0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSempServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Stand-in for a router's SEMP endpoint, answering the RPCs check_solace sends with synthetic replies
+    # for a configurable number of clients, page size and latency.
+    daemon_threads = True
+
+    def __init__(self, clients, page_size=0, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeSempHandler)
+        self.clients = clients
+        self.page_size = page_size
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def semp_reply(message, clients, page_size):
+    # yields the reply body in chunks of at most a thousand clients
+    if '<stats><client>' in message:
+        body = "".join("<%s>%s</%s>" % (tag, clients * 10 + i, tag) for i, tag in enumerate(GLOBAL_STATS_TAGS))
+        if '<detail' in message:
+            body += "".join("<%s>%s</%s>" % (tag, clients + i, tag) for i, tag in enumerate(DETAIL_TAGS))
+        yield "<rpc-reply semp-version='soltr/7_1'><rpc><show><stats><client><global-stats>%s</global-stats>" \
+              "</client></stats></show></rpc><execute-result code='ok'/></rpc-reply>" % body
+        return
+
+    if '<message-spool>' in message:
+        yield "<rpc-reply semp-version='soltr/7_1'><rpc><show><message-spool><message-spool-info>" \
+              "<current-persistent-store-usage>%s</current-persistent-store-usage><max-disk-usage>%s</max-disk-usage>" \
+              "</message-spool-info></message-spool></show></rpc><execute-result code='ok'/></rpc-reply>" \
+              % (clients * 0.01, clients * 0.1 + 1)
+        return
+
+    # "show client *" and "show queue *" RPCs list one entry per client (or queue, as many as there are
+    # clients), split into pages if page_size is set
+    page = 0
+    match = re.search(r'<bench-page>(\d+)</bench-page>', message)
+    if match:
+        page = int(match.group(1))
+    first = page * page_size if page_size else 0
+    last = min(first + page_size, clients) if page_size else clients
+    slow = 'slow-subscriber' in message
+    queues = '<queue>' in message
+
+    if queues:
+        yield "<rpc-reply semp-version='soltr/7_1'><rpc><show><queue><queues>"
+    else:
+        yield "<rpc-reply semp-version='soltr/7_1'><rpc><show><client><primary-virtual-router>"
+    chunk = []
+    for client in xrange(first, last):
+        if queues:
+            chunk.append("<queue><name>queue-%s</name><info><message-vpn>vpn-%s</message-vpn>"
+                         "<num-messages-spooled>%s</num-messages-spooled>"
+                         "<current-spool-usage-in-mb>%s</current-spool-usage-in-mb><bind-count>%s</bind-count>"
+                         "</info></queue>" % (client, client % 16, client, client * 0.001, client % 3))
+            if len(chunk) == 1000:
+                yield "".join(chunk)
+                chunk = []
+            continue
+        if slow and client % 10:
+            continue
+        stats = "".join("<%s>%s</%s>" % (tag, client * (i + 1), tag) for i, tag in enumerate(CLIENT_STATS_TAGS))
+        chunk.append("<client><name>client-%s</name><client-address>10.%s.%s.%s:55555</client-address>"
+                     "<message-vpn>vpn-%s</message-vpn><stats>%s</stats></client>"
+                     % (client, client >> 16 & 255, client >> 8 & 255, client & 255, client % 16, stats))
+        if len(chunk) == 1000:
+            yield "".join(chunk)
+            chunk = []
+    if queues:
+        yield "".join(chunk) + "</queues></queue></show></rpc>"
+    else:
+        yield "".join(chunk) + "</primary-virtual-router></client></show></rpc>"
+    if last < clients:
+        cookie = re.sub(r'(<bench-page>\d+</bench-page>)?</(client|queue)></show>',
+                        r'<bench-page>%s</bench-page></\2></show>' % (page + 1), message, 1)
+        yield "<more-cookie>%s</more-cookie>" % cookie
+    yield "<execute-result code='ok'/></rpc-reply>"
+
+
+def run_mode(server, mode, state_dir):
+    # runs one check_solace process and returns its wall time, CPU time, peak RSS and SEMP request count
+    server.requests = 0
+    output = tempfile.TemporaryFile()
+    started = time.time()
+    process = subprocess.Popen([sys.executable, CHECK_SOLACE, "-H", "127.0.0.1", "-p", str(server.server_port),
+                                "-w", "1000000000", "-c", "2000000000", "--" + mode],
+                               stdout=output, stderr=subprocess.STDOUT, env=dict(os.environ, TMPDIR=state_dir))
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    wall = time.time() - started
+    if status != 0:
+        output.seek(0)
+        sys.stderr.write("%s failed:\n%s\n" % (mode, output.read()))
+    return {'wall_ms': round(wall * 1000, 1),
+            'cpu_ms': round((usage.ru_utime + usage.ru_stime) * 1000, 1),
+            'max_rss_kb': usage.ru_maxrss,
+            'requests': server.requests,
+            'ok': status == 0}
+
+
+def run_benchmark():
+    results = []
+    state_dir = tempfile.mkdtemp(prefix="check_solace_bench_")
+    try:
+        for clients in CLIENT_COUNTS:
+            server = FakeSempServer(clients, PAGE_SIZE, LATENCY)
+            server.start()
+            for mode in MODES:
+                runs = [run_mode(server, mode, state_dir) for _ in range(REPEAT)]
+                best = min(runs, key=lambda run: run['wall_ms'])
+                best.update({'mode': mode, 'clients': clients, 'page_size': PAGE_SIZE,
+                             'latency_ms': LATENCY * 1000})
+                results.append(best)
+                print format_row(best)
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(state_dir)
+    return results
+
+
+def format_row(result, baseline=None):
+    row = "%-30s %8s %10.1f %10.1f %10s %4s" % (result['mode'], result['clients'], result['wall_ms'],
+                                                result['cpu_ms'], result['max_rss_kb'], result['requests'])
+    if baseline:
+        row += "  wall %+.0f%% cpu %+.0f%% rss %+.0f%%" % (change(baseline['wall_ms'], result['wall_ms']),
+                                                         change(baseline['cpu_ms'], result['cpu_ms']),
+                                                         change(baseline['max_rss_kb'], result['max_rss_kb']))
+    return row
+
+
+def change(before, after):
+    if not before:
+        return 0.0
+    return (float(after) - before) / before * 100
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = dict(((run['mode'], run['clients']), run) for run in json.load(f)['results'])
+    print "\nCompared with %s:" % baseline_file
+    for result in results:
+        previous = baseline.get((result['mode'], result['clients']))
+        if previous:
+            print format_row(result, previous)
+
+
+if __name__ == '__main__':
+    CLIENT_COUNTS = [10, 1000, 100000]
+    PAGE_SIZE = 0
+    LATENCY = 0
+    REPEAT = 3
+    MODES = list(CHECK_MODES)
+    OUTPUT = None
+    BASELINE = None
+
+    parse_options()
+
+    print "%-30s %8s %10s %10s %10s %4s" % ("mode", "clients", "wall_ms", "cpu_ms", "max_rss_kb", "reqs")
+    results = run_benchmark()
+
+    if OUTPUT is not None:
+        with open(OUTPUT, 'w') as f:
+            json.dump({'time': time.time(), 'python': sys.version.split()[0], 'results': results}, f, indent=1)
+    if BASELINE is not None:
+        compare(results, BASELINE)
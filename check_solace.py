@@ -4,34 +4,133 @@
 check_solace - Checks Solace Systems Message Router statistics
 """
 
+import BaseHTTPServer
+import Queue
+import SocketServer
+import collections
+import fcntl
 import getopt
+import hashlib
+import heapq
+import json
+import math
+import mmap
 import os
+import signal
+import socket
+import stat
+import struct
 import sys
 import tempfile
+import threading
 import time
-from datetime import datetime
-from xml.dom import minidom
+from multiprocessing.pool import ThreadPool
+from xml.etree import cElementTree as ElementTree
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+from requests.packages.urllib3.util.retry import Retry
+
+STATS_CLIENT_RPC = "<rpc semp-version='soltr/7_1'><show><stats><client></client></stats></show></rpc>"
+STATS_CLIENT_DETAIL_RPC = "<rpc semp-version='soltr/7_1'><show><stats><client><detail></detail></client></stats></show></rpc>"
+SLOW_SUBSCRIBER_RPC = "<rpc semp-version='soltr/7_1'><show><client><name>*</name><slow-subscriber></slow-subscriber></client></show></rpc>"
+CLIENT_STATS_RPC = "<rpc semp-version='soltr/7_1'><show><client><name>*</name><stats></stats></client></show></rpc>"
+MESSAGE_SPOOL_RPC = "<rpc semp-version='soltr/7_1'><show><message-spool></message-spool></show></rpc>"
+QUEUE_DETAIL_RPC = "<rpc semp-version='soltr/7_1'><show><queue><name>*</name><detail></detail></queue></show></rpc>"
+
+# check statuses from least to most severe, and the plugin exit code Nagios expects for each
+SEVERITY = ["OK", "Unknown", "Warning", "Critical"]
+EXIT_CODES = {"OK": 0, "Warning": 1, "Critical": 2, "Unknown": 3}
+
+# samples older than this are ignored by check modes, which then query the router directly
+COLLECTOR_MAX_AGE = 180
+
+# seconds a rendered /metrics page is reused, so several Prometheus replicas scraping together cost one poll
+SCRAPE_CACHE_TTL = 10
+# per-client counters summed into the exporter's per-VPN metrics
+VPN_COUNTERS = ['total-client-messages-received', 'total-client-messages-sent', 'total-client-bytes-received',
+                'total-client-bytes-sent', 'total-ingress-discards', 'total-egress-discards']
+# discard counters exported as the one solace_discards_total family, by their direction and reason labels;
+# the per-direction totals get reason "total", so sums over reasons must leave that one out
+DISCARD_LABELS = {
+    'total-ingress-discards': ('ingress', 'total'),
+    'no-subscription-match': ('ingress', 'no_subscription_match'),
+    'msg-spool-discards': ('ingress', 'msg_spool'),
+    'message-spool-congestion': ('ingress', 'msg_spool_congestion'),
+    'total-egress-discards': ('egress', 'total'),
+    'transmit-congestion': ('egress', 'transmit_congestion'),
+    'compression-congestion': ('egress', 'compression_congestion'),
+    'msg-spool-egress-discards': ('egress', 'msg_spool'),
+}
+
+# urllib3 backoff factor for SEMP request retries: the first retry is immediate, later ones wait 1s, 2s, 4s...
+RETRY_BACKOFF = 0.5
+# router replies retried as transient failures
+RETRY_STATUSES = (502, 503, 504)
+
+# records a prefetching reply iterator may parse ahead of its caller
+PREFETCH_RECORDS = 1000
+
+# total size of shared reply files kept on disk; the oldest are evicted beyond this
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# partial reply downloads untouched for this long were left by a killed process and are removed
+RESPONSE_CACHE_STALE_TMP = 3600
+
+# counter samples kept per (host, vpn, metric) for rate calculations
+STATE_SAMPLES = 30
+# queue depths only need the previous poll for growth, and a router may have thousands of queues
+QUEUE_STATE_SAMPLES = 2
+# counters not sampled for this long (deleted queues, retired routers) are dropped from the store
+STATE_MAX_AGE = 7 * 24 * 3600
+
+# Layout of the per-router history files: a header, a table of series slots (name, index of the oldest
+# sample, sample count), then a fixed ring of (time, value) doubles for each slot. 64 series of 2880
+# samples keep two days of one-minute polls in under 3MB per router.
+HISTORY_SERIES = 64
+HISTORY_SAMPLES = 2880
+HISTORY_HEADER = struct.Struct("<4sII")
+HISTORY_SLOT = struct.Struct("<48sII")
+HISTORY_SAMPLE = struct.Struct("<dd")
+HISTORY_MAGIC = "CSH1"
 
 
 def parse_options():
-    global SOLACE_HOST
+    global SOLACE_HOSTS
     global SOLACE_CLI_USERNAME
     global SOLACE_CLI_PASSWORD
     global SEMP_PORT
-    global MODE
+    global MODES
+    global COMBINED
+    global COLLECTOR
+    global COLLECTOR_SOCKET
+    global EXPORTER
+    global EXPORTER_LISTEN
+    global POLL_INTERVAL
+    global INVENTORY
+    global WORKERS
+    global REQUEST_TIMEOUT
+    global RETRIES
+    global HTTPS
+    global TLS_VERIFY
+    global JSON_OUTPUT
+    global RATE_MODE
+    global PROFILE
+    global RATE_WINDOW
+    global TOP_COUNT
+    global TOP_METRICS
+    global RESPONSE_CACHE_TTL
+    global HISTORY
+    global TREND
+    global TREND_RANGE
+    global TREND_STATISTIC
     global CRITICAL
     global WARNING
 
     try:
-        long_options = ['SLOW_SUBSCRIBERS', 'CLIENT-MESSAGES-TOTAL', 'DISCARDS', 'DISCARD-RATE', 'EGRESS-DISCARDS',
-                        'INGRESS-DISCARDS', 'CLIENT-MESSAGES-DATA', 'CLIENT-MESSAGES-PERSISTENT',
-                        'CLIENT-MESSAGES-NONPERSISTENT', 'CLIENT-MESSAGES-DIRECT', 'CLIENT-MESSAGES-CONTROL',
-                        'CLIENT-MESSAGES-RATE', 'CLIENT-BYTES-TOTAL', 'CLIENT-BYTES-DATA', 'CLIENT-BYTES-PERSISTENT',
-                        'CLIENT-BYTES-NONPERSISTENT', 'CLIENT-BYTES-DIRECT', 'CLIENT-BYTES-CONTROL',
-                        'CLIENT-BYTES-RATE', 'help']
-        opts, args = getopt.getopt(sys.argv[1:], "hc:w:H:U:P:p:", long_options)
+        long_options = CHECK_MODES + ['COMBINED', 'COLLECTOR', 'EXPORTER', 'JSON', 'RATE', 'PROFILE', 'HTTPS',
+                                      'INSECURE', 'HISTORY', 'TREND', 'help']
+        opts, args = getopt.getopt(sys.argv[1:], "hc:w:H:U:P:p:S:i:f:j:t:r:W:n:m:T:l:C:R:A:", long_options)
     except getopt.GetoptError:
         sys.stderr.write(display_help())
         sys.exit(3)
@@ -40,50 +139,43 @@ def parse_options():
         sys.stderr.write("Unknown arguments: %s\n" % args)
         sys.exit(3)
 
-    MODE = None
+    MODES = []
+    COMBINED = False
+    COLLECTOR = False
+    EXPORTER = False
+    JSON_OUTPUT = False
+    RATE_MODE = False
+    PROFILE = False
+    HISTORY = False
+    TREND = False
     WARNING = None
     CRITICAL = None
 
     for o, a in opts:
-        if o in ('-SLOW_SUBSCRIBERS', "--SLOW_SUBSCRIBERS"):
-            MODE = "SLOW_SUBSCRIBERS"
-        if o in ('-CLIENT-MESSAGES-TOTAL', "--CLIENT-MESSAGES-TOTAL"):
-            MODE = "CLIENT-MESSAGES-TOTAL"
-        if o in ('-DISCARDS', "--DISCARDS"):
-            MODE = "DISCARDS"
-        if o in ('-DISCARD-RATE', "--DISCARD-RATE"):
-            MODE = "DISCARD-RATE"
-        if o in ('-EGRESS-DISCARDS', "--EGRESS-DISCARDS"):
-            MODE = "EGRESS-DISCARDS"
-        if o in ('-INGRESS-DISCARDS', "--INGRESS-DISCARDS"):
-            MODE = "INGRESS-DISCARDS"
-        if o in ('-CLIENT-MESSAGES-DATA', "--CLIENT-MESSAGES-DATA"):
-            MODE = "CLIENT-MESSAGES-DATA"
-        if o in ('-CLIENT-MESSAGES-PERSISTENT', "--CLIENT-MESSAGES-PERSISTENT"):
-            MODE = "CLIENT-MESSAGES-PERSISTENT"
-        if o in ('-CLIENT-MESSAGES-NONPERSISTENT', "--CLIENT-MESSAGES-NONPERSISTENT"):
-            MODE = "CLIENT-MESSAGES-NONPERSISTENT"
-        if o in ('-CLIENT-MESSAGES-DIRECT', "--CLIENT-MESSAGES-DIRECT"):
-            MODE = "CLIENT-MESSAGES-DIRECT"
-        if o in ('-CLIENT-MESSAGES-CONTROL', "--CLIENT-MESSAGES-CONTROL"):
-            MODE = "CLIENT-MESSAGES-CONTROL"
-        if o in ('-CLIENT-MESSAGES-RATE', "--CLIENT-MESSAGES-RATE"):
-            MODE = "CLIENT-MESSAGES-RATE"
-        if o in ('-CLIENT-BYTES-TOTAL', "--CLIENT-BYTES-TOTAL"):
-            MODE = "CLIENT-BYTES-TOTAL"
-        if o in ('-CLIENT-BYTES-DATA', "--CLIENT-BYTES-DATA"):
-            MODE = "CLIENT-BYTES-DATA"
-        if o in ('-CLIENT-BYTES-PERSISTENT', "--CLIENT-BYTES-PERSISTENT"):
-            MODE = "CLIENT-BYTES-PERSISTENT"
-        if o in ('-CLIENT-BYTES-NONPERSISTENT', "--CLIENT-BYTES-NONPERSISTENT"):
-            MODE = "CLIENT-BYTES-NONPERSISTENT"
-        if o in ('-CLIENT-BYTES-DIRECT', "--CLIENT-BYTES-DIRECT"):
-            MODE = "CLIENT-BYTES-DIRECT"
-        if o in ('-CLIENT-BYTES-CONTROL', "--CLIENT-BYTES-CONTROL"):
-            MODE = "CLIENT-BYTES-CONTROL"
-        if o in ('-CLIENT-BYTES-RATE', "--CLIENT-BYTES-RATE"):
-            MODE = "CLIENT-BYTES-RATE"
-
+        if o[2:] in METRICS:
+            MODES.append(o[2:])
+        if o in ('-COMBINED', "--COMBINED"):
+            COMBINED = True
+        if o in ('-COLLECTOR', "--COLLECTOR"):
+            COLLECTOR = True
+        if o in ('-EXPORTER', "--EXPORTER"):
+            EXPORTER = True
+        if o in ('-JSON', "--JSON"):
+            JSON_OUTPUT = True
+        if o in ('-RATE', "--RATE"):
+            RATE_MODE = True
+        if o in ('-PROFILE', "--PROFILE"):
+            PROFILE = True
+        if o in ('-HISTORY', "--HISTORY"):
+            HISTORY = True
+        if o in ('-TREND', "--TREND"):
+            TREND = True
+        if o in ('-HTTPS', "--HTTPS"):
+            HTTPS = True
+        if o in ('-INSECURE', "--INSECURE"):
+            TLS_VERIFY = False
+            # asked for explicitly, so urllib3 need not warn on every request
+            requests.packages.urllib3.disable_warnings()
 
         if o in ('-h', '--help'):
             sys.stdout.write(display_help())
@@ -102,7 +194,7 @@ def parse_options():
                 sys.exit(3)
         if o in ('-H',):
             try:
-                SOLACE_HOST = a
+                SOLACE_HOSTS.append(a)
             except:
                 sys.stderr.write(display_help())
                 sys.exit(3)
@@ -124,8 +216,98 @@ def parse_options():
             except:
                 sys.stderr.write(display_help())
                 sys.exit(3)
+        if o in ('-C',):
+            try:
+                TLS_VERIFY = a
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-S',):
+            try:
+                COLLECTOR_SOCKET = a
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-i',):
+            try:
+                POLL_INTERVAL = int(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-f',):
+            try:
+                INVENTORY = a
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-j',):
+            try:
+                WORKERS = int(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-t',):
+            try:
+                # a single value bounds both connecting and each read, "connect,read" sets them apart
+                timeouts = [float(timeout) for timeout in a.split(',')]
+                REQUEST_TIMEOUT = timeouts[0] if len(timeouts) == 1 else (timeouts[0], timeouts[1])
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-r',):
+            try:
+                RETRIES = int(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-W',):
+            try:
+                RATE_WINDOW = int(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-n',):
+            try:
+                TOP_COUNT = int(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-m',):
+            try:
+                TOP_METRICS = a.split(',')
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-T',):
+            try:
+                RESPONSE_CACHE_TTL = float(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-R',):
+            try:
+                TREND_RANGE = int(a)
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-A',):
+            try:
+                if a != 'avg':
+                    if not a.startswith('p') or not 0 <= float(a[1:]) <= 100:
+                        raise ValueError(a)
+                TREND_STATISTIC = a
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
+        if o in ('-l',):
+            try:
+                address, _, port = a.rpartition(':')
+                EXPORTER_LISTEN = (address, int(port))
+            except:
+                sys.stderr.write(display_help())
+                sys.exit(3)
 
-    return MODE, CRITICAL, WARNING
+    return MODES, CRITICAL, WARNING
 
 
 def display_help():
@@ -133,261 +315,1274 @@ def display_help():
                '\n' \
                '* denotes a required option\n\n'\
                '  -h, -help                            Show this help\n' \
-               '  -H <hostname>                        * Solace hostname or IP address\n' \
-               '  -p <port>                            Solace SEMP port\n' \
+               '  -H <hostname>                        * Solace hostname or IP address, may be repeated\n' \
+               '  -f <file>                            Inventory file with one hostname per line\n' \
+               '  -j <workers>                         Routers polled concurrently (default 10)\n' \
+               '  -t <seconds>[,<seconds>]             SEMP connect and read timeouts (default 5,30)\n' \
+               '  -r <retries>                         SEMP request retries (default 0), the first immediate and the\n' \
+               '                                       rest after 1s, 2s, 4s...; a reply failing after its headers\n' \
+               '                                       arrived is not retried\n' \
+               '  -p <port>                            Solace SEMP port (default 80, or 443 with --HTTPS)\n' \
+               '  -C <file>                            CA bundle used to verify the router\'s certificate\n' \
                '  -U <username>                        Solace SEMP username\n' \
                '  -P <password>                        Solace SEMP password\n' \
+               '  -S <socket>                          Collector UNIX socket path\n' \
+               '  -i <seconds>                         Collector poll interval (default 60)\n' \
+               '  -W <seconds>                         Window for rate calculations (default 60)\n' \
+               '  -T <seconds>                         Share SEMP replies between check processes for this long\n' \
+               '                                       (default 0, no sharing)\n' \
+               '  -n <count>                           Entries reported by TOP-* and QUEUE-* checks (default 5)\n' \
+               '  -m <element>[,<element>...]          Client counters summed for TOP-* checks\n' \
+               '                                       (default total-ingress-discards,total-egress-discards)\n' \
+               '  -R <seconds>                         History compared against by --TREND (default 3600)\n' \
+               '  -A avg|p<percentile>                 Statistic of that history used by --TREND (default avg)\n' \
+               '  -l [<address>:]<port>                Exporter listen address (default :9628)\n' \
                '  -c <value>                           * Critical value\n'\
                '  -w <value>                           * Warning value\n'\
-               '  --SLOW_SUBSCRIBERS                   [*] Check slow subscriber count\n'\
-               '  --CLIENT-MESSAGES-TOTAL              [*] Check total message count\n'\
-               '  --CLIENT-MESSAGES-DATA               [*] Check total message count\n'\
-               '  --CLIENT-MESSAGES-PERSISTENT         [*] Check persistent message count\n'\
-               '  --CLIENT-MESSAGES-NONPERSISTENT      [*] Check non-persistent message count\n'\
-               '  --CLIENT-MESSAGES-DIRECT             [*] Check direct message count\n'\
-               '  --CLIENT-MESSAGES-CONTROL            [*] Check control message count\n'\
-               '  --CLIENT-MESSAGES-RATE               [*] Check 60-second message rate\n'\
-               '  --CLIENT-BYTES-TOTAL                 [*] Check total message bytes\n'\
-               '  --CLIENT-BYTES-DATA                  [*] Check data message bytes\n'\
-               '  --CLIENT-BYTES-PERSISTENT            [*] Check persistent message bytes\n'\
-               '  --CLIENT-BYTES-NONPERSISTENT         [*] Check non-persistent message bytes\n'\
-               '  --CLIENT-BYTES-DIRECT                [*] Check direct message bytes\n'\
-               '  --CLIENT-BYTES-CONTROL               [*] Check control message bytes\n'\
-               '  --CLIENT-BYTES-RATE                  [*] Check 60-second message bandwidth\n'\
-               '  --DISCARDS                    [*] Check ingress/egress discards\n'\
-               '  --DISCARD-RATE                [*] Calculates 1-min ingress/egress discard rate\n'\
-               '  --INGRESS-DISCARDS            [*] Checks ingress discards\n'\
-               '  --EGRESS-DISCARDS             [*] Checks egress discards\n\n'
-
-    return help_msg
-
-
-def solace_slow_subscribers():
-    slow_subscribers = 0
-    message = "<rpc semp-version='soltr/7_1'><show><client><name>*</name><slow-subscriber></slow-subscriber></client></show></rpc>"
-    r = requests.post(call_path, auth=(SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD), data=message)
-    output = minidom.parseString(r.content)
-    if output.getElementsByTagName('client'):
-        clients = output.getElementsByTagName('client-address')
-        for client in clients:
-            slow_subscribers += 1
+               '%s'\
+               '  --COMBINED                           Report multiple checks as a single result line\n'\
+               '  --JSON                               Print one JSON document per router instead of Nagios lines\n'\
+               '  --RATE                               Report counter checks as rates per -W seconds\n'\
+               '  --HTTPS                              Use HTTPS for SEMP requests\n'\
+               '  --INSECURE                           Do not verify the router\'s HTTPS certificate\n'\
+               '  --HISTORY                            Record every check value in a per-router history file\n'\
+               '  --TREND                              Compare values with their -A statistic over the last -R\n'\
+               '                                       seconds; -w and -c are then multiples of that baseline\n'\
+               '  --PROFILE                            Add SEMP request, transfer and parse timings to the perfdata\n'\
+               '                                       (and a per-RPC trace to --JSON documents)\n'\
+               '  --COLLECTOR                          Run as a collector daemon polling every -H router each -i\n' \
+               '                                       seconds and serving the latest replies on the -S socket\n' \
+               '  --EXPORTER                           Serve every -H router\'s metrics for Prometheus on -l /metrics\n\n' \
+               'Several check options may be given at once; each distinct SEMP request is then sent only once\n' \
+               'and one result line is printed per check (or a single line with --COMBINED).\n' \
+               'With several routers (-H repeated or -f) they are polled concurrently and every result line\n' \
+               'is prefixed with its hostname.\n' \
+               'When -S is given to a check, replies are read from the collector and the router is only\n' \
+               'queried directly if the collector has no recent sample.\n' \
+               'With --EXPORTER, rate checks are left out of /metrics since Prometheus derives rates itself.\n' \
+               'Discard counters are exported as solace_discards_total by direction and reason.\n' \
+               'With --TREND, counters are compared as rates per -W seconds since the previous poll, e.g.\n' \
+               '--DISCARDS --TREND -R 3600 -w 3 -c 5 is Critical at five times the hourly average discard rate.\n\n'
+
+    modes_help = "".join("  %-37s[*] %s\n" % ("--" + mode, metric['help']) for mode, metric in METRICS.items())
+    return help_msg % modes_help
+
+
+class SempRouter(object):
+    def __init__(self, host):
+        self.host = host
+        self.port = str(SEMP_PORT or (443 if HTTPS else 80))
+        self.call_path = ("https://" if HTTPS else "http://") + host + ":" + self.port + SEMP_PATH
+        # One keep-alive session per router, so repeated RPCs reuse the same connection (and, over HTTPS,
+        # the same TLS session). Connection failures, read timeouts and gateway errors are retried by
+        # urllib3 with backoff; SEMP show RPCs are read-only, so POSTs are safe to resend.
+        self.session = requests.Session()
+        self.session.auth = (SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD)
+        self.session.headers['Accept-Encoding'] = "gzip, deflate"
+        retry = dict(total=RETRIES, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES)
+        try:
+            retry = Retry(allowed_methods=None, **retry)
+        except TypeError:
+            # urllib3 before 1.26
+            retry = Retry(method_whitelist=False, **retry)
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # extracted replies for this run, keyed by RPC body, so each distinct RPC is only sent once
+        self.replies = {}
+        # per-RPC phase timings of the replies read in this run, recorded with --PROFILE
+        self.timings = {}
+
+    def post(self, message):
+        # also notes in replies when the reply was taken, which rates are measured by: now, or for a reply
+        # shared through the cache, when its file was written
+        reply = cached_reply(self, message) if RESPONSE_CACHE_TTL > 0 else None
+        if reply is not None:
+            self.replies[('time', message)] = os.fstat(reply.fileno()).st_mtime
+            return reply
+        self.replies[('time', message)] = time.time()
+        return self.fetch(message)
+
+    def fetch(self, message):
+        # verify is passed per request, as a session setting would be overridden by REQUESTS_CA_BUNDLE
+        r = self.session.post(self.call_path, data=message, stream=True, timeout=REQUEST_TIMEOUT,
+                              verify=TLS_VERIFY)
+        # an error page would otherwise be parsed (and shared through the cache) as a reply with no values
+        r.raise_for_status()
+        # compressed replies are inflated as they are parsed
+        r.raw.decode_content = True
+        return ReplyStream(r.raw)
+
+    def events(self, message):
+        # iterparse start/end events for every page of the reply. SEMP splits long replies into pages and
+        # ends each one with a <more-cookie> holding the RPC for the next page; the cookie is followed to
+        # the last page and its own elements are not passed on.
+        timing = None
+        if PROFILE:
+            timing = self.timings[message] = {'requests': 0, 'semp_latency': 0.0, 'transfer': 0.0, 'parse': 0.0,
+                                              'reply_bytes': 0, 'elements': 0}
+        while message is not None:
+            started = time.time()
+            source = self.post(message)
+            message = None
+            in_cookie = False
+            if timing is None:
+                parser = ElementTree.iterparse(source, events=('start', 'end'))
+            else:
+                timing['requests'] += 1
+                timing['semp_latency'] += time.time() - started
+                parser = timed_events(ElementTree.iterparse(TimedReader(source, timing), events=('start', 'end')),
+                                      timing)
+            for event, elem in parser:
+                if elem.tag == 'more-cookie':
+                    in_cookie = event == 'start'
+                    if not in_cookie and len(elem):
+                        message = ElementTree.tostring(elem[0])
+                    continue
+                if not in_cookie:
+                    yield event, elem
+
+    def extract(self, message):
+        return extract_elements(self.events(message))
+
+    def records(self, message, record_tag, prefetch=False):
+        records = iter_records(self.events(message), record_tag)
+        if prefetch:
+            return prefetched(records)
+        return records
+
+
+class ReplyStream(object):
+    # File-like reply body that raises failures while reading it as requests exceptions, as
+    # Response.iter_content does, so a router stalling or dropping the connection mid-reply is handled
+    # like any other failed request instead of escaping as a urllib3 error.
+    def __init__(self, raw):
+        self.raw = raw
+
+    def read(self, size=-1):
+        try:
+            return self.raw.read(size)
+        except urllib3_exceptions.ReadTimeoutError as e:
+            raise requests.ConnectionError(e)
+        except urllib3_exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except urllib3_exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except urllib3_exceptions.HTTPError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+
+class TimedReader(object):
+    # file-like wrapper adding the time spent waiting for reply bytes, and their count, to a timing record
+    def __init__(self, source, timing):
+        self.source = source
+        self.timing = timing
+
+    def read(self, size=-1):
+        started = time.time()
+        data = self.source.read(size)
+        self.timing['transfer'] += time.time() - started
+        self.timing['reply_bytes'] += len(data)
+        return data
+
+
+def timed_events(parser, timing):
+    # Yields the parser's events, adding the time spent producing them to the timing record. The reads
+    # made meanwhile are timed by TimedReader and subtracted, so 'parse' is time spent in the parser alone
+    # and time the caller spends between events is not counted at all.
+    parser = iter(parser)
+    while True:
+        started = time.time()
+        transfer = timing['transfer']
+        try:
+            event, elem = next(parser)
+        except StopIteration:
+            return
+        finally:
+            timing['parse'] += time.time() - started - (timing['transfer'] - transfer)
+        if event == 'end':
+            timing['elements'] += 1
+        yield event, elem
+
+
+def profile_perfdata(router, mode, prefix=""):
+    # SEMP timing perfdata for the RPC behind a check; empty if the reply came from the collector
+    timing = router.timings.get(METRICS[mode]['rpc'])
+    if timing is None:
+        return ""
+    return "%ssemp_latency_ms=%.1f %stransfer_ms=%.1f %sparse_ms=%.1f %sreply_bytes=%dB %selements=%d" \
+           % (prefix, timing['semp_latency'] * 1000, prefix, timing['transfer'] * 1000, prefix,
+              timing['parse'] * 1000, prefix, timing['reply_bytes'], prefix, timing['elements'])
+
+
+def profile_trace(router):
+    # the timings of every RPC sent in this run, in milliseconds, for the --JSON document
+    trace = []
+    for message, timing in router.timings.items():
+        trace.append({'rpc': message, 'requests': timing['requests'],
+                      'semp_latency_ms': round(timing['semp_latency'] * 1000, 1),
+                      'transfer_ms': round(timing['transfer'] * 1000, 1),
+                      'parse_ms': round(timing['parse'] * 1000, 1),
+                      'reply_bytes': timing['reply_bytes'], 'elements': timing['elements']})
+    return trace
+
+
+def private_directory(path):
+    # The cache directory sits at a predictable path under the temp directory, so another local user could
+    # create it first and plant replies in it; it is only used if it is a real directory owned by this user
+    # that nobody else can write to.
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0022
+
+
+def cached_reply(router, message):
+    # Returns the reply to this RPC from the shared on-disk cache, fetching it first if the cached copy is
+    # missing or older than RESPONSE_CACHE_TTL. The per-RPC lock is held during the fetch, so concurrent
+    # checks asking for the same RPC wait for that one request instead of sending their own. None means the
+    # cache directory cannot be trusted and the reply is to be fetched directly.
+    # the URL carries the scheme, host and port; runs with another username may see other replies
+    key = hashlib.sha1("\n".join((router.call_path, SOLACE_CLI_USERNAME, message))).hexdigest()
+    filename = os.path.join(RESPONSE_CACHE_DIR, key + ".xml")
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, 0700)
+    except OSError:
+        pass
+    if not private_directory(RESPONSE_CACHE_DIR):
+        sys.stderr.write("Not sharing replies: %s is not a directory only this user can write to\n"
+                         % RESPONSE_CACHE_DIR)
+        return None
+
+    lock_file = open(os.path.join(RESPONSE_CACHE_DIR, key + ".lock"), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        try:
+            fresh = time.time() - os.path.getmtime(filename) < RESPONSE_CACHE_TTL
+        except OSError:
+            fresh = False
+        if fresh:
+            # an open file keeps its contents even if another process replaces or evicts it meanwhile, but
+            # eviction does not take this lock and may remove it between the check and the open
+            try:
+                return open(filename, 'rb')
+            except IOError:
+                pass
+
+        source = router.fetch(message)
+        fd, temp_filename = tempfile.mkstemp(dir=RESPONSE_CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in iter(lambda: source.read(65536), ""):
+                    temp_file.write(chunk)
+            os.rename(temp_filename, filename)
+        except:
+            os.unlink(temp_filename)
+            raise
+        reply = open(filename, 'rb')
+        evict_replies()
+        return reply
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def evict_replies():
+    # drops expired replies, then the oldest ones until the cache fits in RESPONSE_CACHE_MAX_BYTES, and
+    # the partial downloads of killed processes; lock files are left in place so that processes waiting
+    # on them keep excluding each other
+    replies = []
+    now = time.time()
+    for name in os.listdir(RESPONSE_CACHE_DIR):
+        if name.endswith(".xml") or name.endswith(".tmp"):
+            try:
+                info = os.stat(os.path.join(RESPONSE_CACHE_DIR, name))
+            except OSError:
+                continue
+            if name.endswith(".xml"):
+                replies.append((info.st_mtime, info.st_size, name))
+            elif now - info.st_mtime > RESPONSE_CACHE_STALE_TMP:
+                try:
+                    os.unlink(os.path.join(RESPONSE_CACHE_DIR, name))
+                except OSError:
+                    pass
+    replies.sort()
+    total = sum(size for mtime, size, name in replies)
+    for mtime, size, name in replies:
+        if now - mtime < RESPONSE_CACHE_TTL and total <= RESPONSE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.unlink(os.path.join(RESPONSE_CACHE_DIR, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def semp_extract(router, message):
+    if message not in router.replies:
+        reply = None
+        if COLLECTOR_SOCKET:
+            reply = collector_query(COLLECTOR_SOCKET, router.host, router.port, message)
+            if reply is not None:
+                reply, router.replies[('time', message)] = reply
+        if reply is None:
+            reply = router.extract(message)
+        router.replies[message] = reply
+    return router.replies[message]
+
+
+def reply_time(router, message):
+    # when the reply to this RPC was taken from the router
+    return router.replies.get(('time', message), time.time())
+
+
+def extract_elements(events):
+    # Parses the reply as it is read, keeping only the first text value and the occurrence count of each
+    # element name. Every element is detached from its parent once it ends, so memory use stays flat no
+    # matter how many clients the reply lists.
+    values = {}
+    counts = {}
+    stack = []
+    for event, elem in events:
+        if event == 'start':
+            if stack:
+                stack[-1][1] = True
+            stack.append([elem, False])
+            continue
+        has_children = stack.pop()[1]
+        counts[elem.tag] = counts.get(elem.tag, 0) + 1
+        if not has_children and elem.tag not in values and elem.text is not None:
+            values[elem.tag] = elem.text.strip()
+        if stack:
+            stack[-1][0].remove(elem)
+    return values, counts
+
+
+def iter_records(events, record_tag):
+    # Yields one dict of leaf element values per record - a record_tag element with a <name> child, such as
+    # each <client> of a "show client *" reply. Records are detached once read, and elements outside any
+    # record_tag element are detached as soon as they end, so only the current record is held in memory.
+    stack = []
+    open_records = 0
+    for event, elem in events:
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == record_tag:
+                open_records += 1
+            continue
+        stack.pop()
+        if elem.tag == record_tag:
+            open_records -= 1
+            if elem.find('name') is not None:
+                record = {}
+                for child in elem.iter():
+                    if len(child) == 0 and child.tag not in record and child.text is not None:
+                        record[child.tag] = child.text.strip()
+                record['name'] = elem.findtext('name').strip()
+                if stack:
+                    stack[-1].remove(elem)
+                yield record
+                continue
+        if stack and not open_records:
+            stack[-1].remove(elem)
+
+
+def prefetched(iterator):
+    # Runs the iterator on a background thread, up to PREFETCH_RECORDS items ahead of the caller, so the
+    # next reply page is requested and parsed while the caller is still working through the current one.
+    queue = Queue.Queue(PREFETCH_RECORDS)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                queue.put((item, None))
+        except Exception as e:
+            queue.put((done, e))
+            return
+        queue.put((done, None))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    while True:
+        item, error = queue.get()
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
+def collector_query(socket_path, host, port, message):
+    # returns the collector's latest (values, counts) for this RPC and the time it was polled, or None if
+    # it has nothing recent
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'host': host, 'port': port, 'rpc': message}) + "\n")
+        data = sock.makefile('r').read()
+        sock.close()
+        sample = json.loads(data)
+    except (socket.error, ValueError):
+        return None
+    if not sample or time.time() - sample['time'] > COLLECTOR_MAX_AGE:
+        return None
+    return (sample['values'], sample['counts']), sample['time']
+
+
+class CollectorHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            query = json.loads(self.rfile.readline())
+            key = (query['host'], query['port'], query['rpc'])
+        except (ValueError, KeyError):
+            return
+        self.wfile.write(json.dumps(self.server.samples.get(key, {})))
+
+
+class CollectorServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def collector_poll(router, samples, interval):
+    while True:
+        started = time.time()
+        for message in COLLECTOR_RPCS:
+            polled = time.time()
+            try:
+                values, counts = router.extract(message)
+            except Exception as e:
+                # whatever went wrong, this router is polled again next interval
+                sys.stderr.write("Polling %s failed: %s\n" % (router.host, e))
+                continue
+            samples[(router.host, router.port, message)] = {'time': polled, 'values': values, 'counts': counts}
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+def run_collector(hosts, socket_path, interval):
+    samples = {}
+    for host in hosts:
+        poller = threading.Thread(target=collector_poll, args=(SempRouter(host), samples, interval))
+        poller.daemon = True
+        poller.start()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = CollectorServer(socket_path, CollectorHandler)
+    server.samples = samples
+    # exit through the finally block on SIGTERM so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(socket_path)
+
+
+class CounterStore(object):
+    # Recent counter samples shared by every check process, keyed by (host, vpn, metric), keeping up to
+    # samples per key. The store is used as a context manager: entering takes an exclusive lock and loads
+    # the file, leaving writes it back atomically through a temporary file and releases the lock.
+    def __init__(self, filename, samples=STATE_SAMPLES):
+        self.filename = filename
+        self.samples = samples
+        self.counters = {}
+        self.lock_file = None
+
+    def __enter__(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename))
+        except OSError:
+            pass
+        self.lock_file = open(self.filename + ".lock", 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            with open(self.filename) as state_file:
+                self.counters = json.load(state_file)
+        except (IOError, ValueError):
+            # first run, or a store left unreadable - start again from empty
+            self.counters = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                oldest = time.time() - STATE_MAX_AGE
+                for key in [key for key, samples in self.counters.iteritems() if samples[-1][0] < oldest]:
+                    del self.counters[key]
+                fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+                with os.fdopen(fd, 'w') as temp_file:
+                    json.dump(self.counters, temp_file)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                os.rename(temp_filename, self.filename)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+
+    def rate(self, host, vpn, metric, value, now, window, monotonic=True):
+        # records the sample and returns the counter's increase per window seconds, measured from the
+        # newest sample at least window seconds old (or the oldest one kept); None until there are two.
+        # Gauges such as queue depths pass monotonic=False, so a decrease is a negative rate, not a reset.
+        samples = self.counters.setdefault("\t".join((host, vpn, metric)), [])
+        if samples and now <= samples[-1][0]:
+            if now < samples[-1][0]:
+                # older than what is already recorded, from a stale shared reply
+                return None
+            # the same reply was recorded by an earlier check; it is measured again from the samples before it
+            samples.pop()
+        if monotonic and samples and value < samples[-1][1]:
+            # the counter went backwards - the router restarted or its stats were cleared
+            del samples[:]
+        samples.append([now, value])
+        del samples[:-self.samples]
+
+        base = samples[0]
+        for sample in samples[1:-1]:
+            if now - sample[0] < window:
+                break
+            base = sample
+        if now <= base[0]:
+            return None
+        return (value - base[1]) * window / (now - base[0])
+
+
+def state_file(router, kind):
+    # every router has its own stores, so checks on different routers never wait on each other's lock;
+    # queue depths are kept apart from the other counters so that their volume does not slow those down
+    return os.path.join(STATE_DIR, "%s_%s.%s.json" % (router.host.replace(os.sep, "_"), router.port, kind))
+
+
+def counter_rates(router, vpn, counters, now):
+    # rates per RATE_WINDOW seconds for a list of (metric, value) counters read from one router at now
+    with CounterStore(state_file(router, "counters")) as store:
+        return [store.rate(router.host, vpn, metric, float(value), now, RATE_WINDOW) for metric, value in counters]
+
+
+def format_rate(rate):
+    # Nagios perfdata uses U for a value that cannot be determined yet
+    if rate is None:
+        return "U"
+    return "%.2f" % rate
+
+
+class HistoryRing(object):
+    # Fixed-size binary history of one router's check values, memory-mapped and shared by every check
+    # process. Each series is a ring of (time, value) samples in time order, so lookups by time are a
+    # binary search. Like CounterStore it is a context manager holding an exclusive lock while in use.
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.map = None
+        self.data_offset = HISTORY_HEADER.size + HISTORY_SERIES * HISTORY_SLOT.size
+        self.size = self.data_offset + HISTORY_SERIES * HISTORY_SAMPLES * HISTORY_SAMPLE.size
+
+    def __enter__(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename))
+        except OSError:
+            pass
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        self.file = os.fdopen(fd, 'r+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        header = self.file.read(HISTORY_HEADER.size)
+        if header != HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_SERIES, HISTORY_SAMPLES):
+            # new file, or one written with another layout - start again from empty
+            self.file.seek(0)
+            self.file.truncate(0)
+            self.file.write(HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_SERIES, HISTORY_SAMPLES))
+            self.file.truncate(self.size)
+            self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.map.close()
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+
+    def slot(self, name, create=False):
+        # index of the series' slot; a new series takes a free slot or the one updated least recently
+        key = name if len(name) <= 48 else hashlib.sha1(name).hexdigest()
+        free = None
+        for index in range(HISTORY_SERIES):
+            slot_key = HISTORY_SLOT.unpack_from(self.map, HISTORY_HEADER.size + index * HISTORY_SLOT.size)[0]
+            slot_key = slot_key.rstrip("\0")
+            if slot_key == key:
+                return index
+            if not slot_key and free is None:
+                free = index
+        if not create:
+            return None
+        if free is None:
+            free = min(range(HISTORY_SERIES), key=lambda index: self.newest(index)[0])
+        HISTORY_SLOT.pack_into(self.map, HISTORY_HEADER.size + free * HISTORY_SLOT.size, key, 0, 0)
+        return free
+
+    def sample_offset(self, index, position):
+        return self.data_offset + (index * HISTORY_SAMPLES + position % HISTORY_SAMPLES) * HISTORY_SAMPLE.size
+
+    def sample(self, index, position):
+        # the position'th oldest sample of a slot
+        start = HISTORY_SLOT.unpack_from(self.map, HISTORY_HEADER.size + index * HISTORY_SLOT.size)[1]
+        return HISTORY_SAMPLE.unpack_from(self.map, self.sample_offset(index, start + position))
+
+    def newest(self, index):
+        count = HISTORY_SLOT.unpack_from(self.map, HISTORY_HEADER.size + index * HISTORY_SLOT.size)[2]
+        if not count:
+            return 0, 0
+        return self.sample(index, count - 1)
+
+    def samples(self, name, since):
+        # (time, value) samples of a series no older than since, oldest first
+        index = self.slot(name)
+        if index is None:
+            return []
+        count = HISTORY_SLOT.unpack_from(self.map, HISTORY_HEADER.size + index * HISTORY_SLOT.size)[2]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.sample(index, middle)[0] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return [self.sample(index, position) for position in range(low, count)]
+
+    def append(self, name, now, value):
+        index = self.slot(name, create=True)
+        slot_offset = HISTORY_HEADER.size + index * HISTORY_SLOT.size
+        key, start, count = HISTORY_SLOT.unpack_from(self.map, slot_offset)
+        if count and self.sample(index, count - 1)[0] >= now:
+            # the clock went backwards; keep the series in time order
+            return
+        HISTORY_SAMPLE.pack_into(self.map, self.sample_offset(index, start + count), now, value)
+        if count < HISTORY_SAMPLES:
+            count += 1
+        else:
+            start = (start + 1) % HISTORY_SAMPLES
+        HISTORY_SLOT.pack_into(self.map, slot_offset, key, start, count)
+
+
+def history_file(router):
+    return os.path.join(HISTORY_DIR, "%s_%s.ring" % (router.host.replace(os.sep, "_"), router.port))
+
+
+def record_history(router, readings, now):
+    with HistoryRing(history_file(router)) as history:
+        for element, label, value in readings:
+            try:
+                history.append(element, now, float(value))
+            except ValueError:
+                pass
+
+
+def interval_rates(samples):
+    # a counter's increase per RATE_WINDOW seconds between consecutive samples, skipping resets
+    rates = []
+    for (t0, v0), (t1, v1) in zip(samples, samples[1:]):
+        if v1 >= v0 and t1 > t0:
+            rates.append((v1 - v0) * RATE_WINDOW / (t1 - t0))
+    return rates
+
+
+def trend_statistic(values):
+    # the -A statistic: the mean, or a nearest-rank percentile such as p95
+    if TREND_STATISTIC == 'avg':
+        return sum(values) / len(values)
+    values = sorted(values)
+    rank = int(math.ceil(float(TREND_STATISTIC[1:]) * len(values) / 100))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def trend_result(router, entry, readings):
+    # Records the readings and compares each one with the -A statistic of its history over TREND_RANGE
+    # seconds. Counters are compared as rates since the previous poll. -w and -c are multiples of the
+    # baseline, and a value with no history or a zero baseline has no ratio and cannot trigger them.
+    # Samples carry the reply's time, so checks sharing a reply record it once and see the same history.
+    now = reply_time(router, entry['rpc'])
+    counter = entry['compute'] == 'rate' or entry['counter']
+    trends = []
+    with HistoryRing(history_file(router)) as history:
+        for element, label, value in readings:
+            value = float(value)
+            samples = [sample for sample in history.samples(element, now - TREND_RANGE) if sample[0] < now]
+            history.append(element, now, value)
+            if counter:
+                series = interval_rates(samples)
+                current = None
+                if samples and value >= samples[-1][1] and now > samples[-1][0]:
+                    current = (value - samples[-1][1]) * RATE_WINDOW / (now - samples[-1][0])
+                if entry['compute'] != 'rate':
+                    label = "%s_Per_%ssec" % (label, RATE_WINDOW)
+            else:
+                series = [sample[1] for sample in samples]
+                current = value
+            baseline = trend_statistic(series) if series else None
+            ratio = current / baseline if current is not None and baseline else None
+            trends.append((label, current, baseline, ratio))
+
     status = "OK"
-    if int(slow_subscribers) >= int(CRITICAL):
+    ratios = [ratio for label, current, baseline, ratio in trends if ratio is not None]
+    if ratios and max(ratios) >= float(CRITICAL):
         status = "Critical"
-    elif int(slow_subscribers) >= int(WARNING):
+    elif ratios and max(ratios) >= float(WARNING):
         status = "Warning"
-    print "SLOW_SUBSCRIBERS", status, "-", "Slow_Subscribers = %s|Slow_Subscribers=%s;%s;%s;0" \
-                                           % (slow_subscribers, slow_subscribers, WARNING, CRITICAL)
-
-
-def solace_discards():
-    ingress_discards = 0
-    egress_discards = 0
-    message = "<rpc semp-version='soltr/7_1'><show><stats><client></client></stats></show></rpc>"
-    r = requests.post(call_path, auth=(SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD), data=message)
-    output = minidom.parseString(r.content)
-    if output.getElementsByTagName('client'):
-        ingress_discards = output.getElementsByTagName('total-ingress-discards')[0].firstChild.nodeValue
-        egress_discards = output.getElementsByTagName('total-egress-discards')[0].firstChild.nodeValue
-    status = "OK"
-    print "DISCARDS", status, "-", "Ingress_Discards = %s Egress_Discards = %s|Ingress_Discards=%s;%s;%s;0 " \
-                                   "Egress_Discards=%s;%s;%s;0" \
-                                   % (ingress_discards, egress_discards, ingress_discards, WARNING, CRITICAL,
-                                      egress_discards, WARNING, CRITICAL)
-
-
-def solace_egress_discards():
-    transmit_congestion_discards = 0
-    compression_congestion_discards = 0
-    egress_discards = 0
-    msg_spool_discards = 0
-    message = "<rpc semp-version='soltr/7_1'><show><stats><client><detail></detail></client></stats></show></rpc>"
-    r = requests.post(call_path, auth=(SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD), data=message)
-    output = minidom.parseString(r.content)
-    if output.getElementsByTagName('client'):
-        egress_discards = output.getElementsByTagName('total-egress-discards')[0].firstChild.nodeValue
-        transmit_congestion_discards = output.getElementsByTagName('transmit-congestion')[0].firstChild.nodeValue
-        compression_congestion_discards = output.getElementsByTagName('compression-congestion')[0].firstChild.nodeValue
-        msg_spool_discards = output.getElementsByTagName('msg-spool-egress-discards')[0].firstChild.nodeValue
+    messages = []
+    perfdata = []
+    for label, current, baseline, ratio in trends:
+        if baseline is None:
+            messages.append("%s = %s (no history over %ssec yet)" % (label, format_rate(current), TREND_RANGE))
+        elif not baseline:
+            messages.append("%s = %s (zero %s baseline over %ssec)" % (label, format_rate(current), TREND_STATISTIC,
+                                                                      TREND_RANGE))
+        elif ratio is None:
+            # a counter reset since the previous poll leaves no current rate to compare
+            messages.append("%s = %s (%s %.2f over %ssec)" % (label, format_rate(current), TREND_STATISTIC,
+                                                             baseline, TREND_RANGE))
+        else:
+            messages.append("%s = %s (%sx %s %.2f over %ssec)" % (label, format_rate(current), format_rate(ratio),
+                                                                 TREND_STATISTIC, baseline, TREND_RANGE))
+        perfdata.append("%s=%s;;;0 %s_Trend=%s;%s;%s;0" % (label, format_rate(current), label, format_rate(ratio),
+                                                          WARNING, CRITICAL))
+    return entry['heading'], status, "%s|%s" % (" ".join(messages), " ".join(perfdata))
+
+
+def read_inventory(filename):
+    hosts = []
+    with open(filename) as inventory:
+        for line in inventory:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                hosts.append(line)
+    return hosts
+
+
+def poll_host(host):
+    # runs every requested check against one router, sharing one SempRouter so each RPC is sent once; a
+    # failed router reports Unknown instead of aborting the run
+    router = SempRouter(host)
+    try:
+        results = run_checks(router, MODES)
+    except Exception as e:
+        # run_checks reports its own failures per check; this only keeps anything else from ending the run
+        results = [(mode, "Unknown", "Checking %s failed: %s" % (host, e)) for mode in MODES]
+    if COMBINED:
+        results = [combine_results(results)]
+    return host, results, router
+
+
+def format_result(result):
+    heading, status, output = result
+    return "%s %s - %s" % (heading, status, output)
+
+
+def format_json(host, results, router=None):
+    checks = []
+    for heading, status, output in results:
+        message, _, perfdata = output.partition("|")
+        checks.append({'check': heading, 'status': status, 'message': message, 'perfdata': perfdata})
+    document = {'host': host, 'results': checks}
+    if PROFILE and router is not None:
+        document['profile'] = profile_trace(router)
+    return json.dumps(document)
+
+
+def worst_status(statuses):
+    return max(statuses, key=SEVERITY.index) if statuses else "OK"
+
+
+def combine_results(results):
+    # worst status wins; messages and perfdata are concatenated in check order
+    status = worst_status([check_status for heading, check_status, output in results])
+    messages = []
+    perfdata = []
+    for heading, check_status, output in results:
+        message, _, perf = output.partition("|")
+        messages.append("%s %s: %s" % (heading, check_status, message))
+        if perf:
+            perfdata.append(perf)
+    return "MULTI", status, "%s|%s" % ("; ".join(messages), " ".join(perfdata))
+
+
+def client_metric(record):
+    total = 0
+    for metric in TOP_METRICS:
+        try:
+            total += int(record.get(metric, 0))
+        except ValueError:
+            pass
+    return total
+
+
+def client_rankings(router):
+    # Ranks every client and message VPN of a "show client * stats" reply by the sum of the TOP_METRICS
+    # counters, in one pass over the reply. Clients go through a heap of TOP_COUNT entries; VPNs are few
+    # enough to total in a dict first.
+    key = ('rankings', CLIENT_STATS_RPC)
+    if key not in router.replies:
+        vpn_totals = {}
+        top_clients = []
+        for record in router.records(CLIENT_STATS_RPC, 'client', prefetch=True):
+            total = client_metric(record)
+            vpn = record.get('message-vpn', '')
+            vpn_totals[vpn] = vpn_totals.get(vpn, 0) + total
+            entry = (total, "%s/%s" % (vpn, record['name']))
+            if len(top_clients) < TOP_COUNT:
+                heapq.heappush(top_clients, entry)
+            elif entry > top_clients[0]:
+                heapq.heapreplace(top_clients, entry)
+        top_vpns = heapq.nlargest(TOP_COUNT, [(total, vpn) for vpn, total in vpn_totals.iteritems()])
+        router.replies[key] = sorted(top_clients, reverse=True), top_vpns
+    return router.replies[key]
+
+
+def top_result(heading, description, top, value=None):
+    # formats (value, label) entries, largest first; the check value compared with -w/-c defaults to the
+    # largest entry
+    if value is None:
+        value = top[0][0] if top else 0
     status = "OK"
-    print "EGRESS-DISCARDS", status, "-", "Total_Egress_Discards = %s Transmit_Congestion_Discards = %s " \
-                                   "Compression_Congestion_Discards = %s Msg_Spool_Egress_Discards = %s|" \
-                                   "Total_Egress_Discards=%s;%s;%s;0 Transmit_Congestion_Discards=%s;%s;%s;0 " \
-                                   "Compression_Congestion_Discards=%s;%s;%s;0 Msg_Spool_Egress_Discards=%s;%s;%s;0" % \
-                                   (egress_discards, transmit_congestion_discards, compression_congestion_discards,
-                                    msg_spool_discards, egress_discards, WARNING, CRITICAL,
-                                    transmit_congestion_discards, WARNING, CRITICAL, compression_congestion_discards,
-                                    WARNING, CRITICAL, msg_spool_discards, WARNING, CRITICAL)
-
-
-def solace_ingress_discards():
-    ingress_discards = 0
-    no_subscription_match = 0
-    msg_spool_discards = 0
-    msg_spool_congestion = 0
-    message = "<rpc semp-version='soltr/7_1'><show><stats><client><detail></detail></client></stats></show></rpc>"
-    r = requests.post(call_path, auth=(SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD), data=message)
-    output = minidom.parseString(r.content)
-    if output.getElementsByTagName('client'):
-        ingress_discards = output.getElementsByTagName('total-ingress-discards')[0].firstChild.nodeValue
-        no_subscription_match = output.getElementsByTagName('no-subscription-match')[0].firstChild.nodeValue
-        msg_spool_discards = output.getElementsByTagName('msg-spool-discards')[0].firstChild.nodeValue
-        msg_spool_congestion = output.getElementsByTagName('message-spool-congestion')[0].firstChild.nodeValue
+    if value >= float(CRITICAL):
+        status = "Critical"
+    elif value >= float(WARNING):
+        status = "Warning"
+    entries = ", ".join("%s = %s" % (label, total) for total, label in top)
+    perfdata = " ".join("'%s'=%s;%s;%s;0" % (label, total, WARNING, CRITICAL) for total, label in top)
+    return heading, status, "%s: %s|%s" % (description, entries or "none", perfdata)
+
+
+def solace_top(router, heading, by_vpn):
+    top_clients, top_vpns = client_rankings(router)
+    top = top_vpns if by_vpn else top_clients
+    return top_result(heading, "Top %s by %s" % (len(top), "+".join(TOP_METRICS)), top)
+
+
+def queue_stats(router):
+    # One (vpn, name, depth, backlog MB, bind count) tuple per queue of a "show queue * detail" reply,
+    # read in a single streaming pass over every page. Only these compact tuples are kept, since the
+    # growth check needs every queue's depth to update its state.
+    key = ('queues', QUEUE_DETAIL_RPC)
+    if key not in router.replies:
+        queues = []
+        for record in router.records(QUEUE_DETAIL_RPC, 'queue', prefetch=True):
+            try:
+                queues.append((record.get('message-vpn', ''), record['name'],
+                               int(record.get('num-messages-spooled', 0)),
+                               float(record.get('current-spool-usage-in-mb', 0)),
+                               int(record.get('bind-count', 0))))
+            except ValueError:
+                continue
+        router.replies[key] = queues
+    return router.replies[key]
+
+
+def solace_queue_depth(router):
+    top = heapq.nlargest(TOP_COUNT, ((depth, "%s/%s" % (vpn, name))
+                                     for vpn, name, depth, backlog, binds in queue_stats(router)))
+    return top_result("QUEUE-DEPTH", "Top %s queues by messages spooled" % len(top), top)
+
+
+def solace_queue_backlog(router):
+    top = heapq.nlargest(TOP_COUNT, ((backlog, "%s/%s" % (vpn, name))
+                                     for vpn, name, depth, backlog, binds in queue_stats(router)))
+    return top_result("QUEUE-BACKLOG", "Top %s queues by spool usage in MB" % len(top), top)
+
+
+def solace_queue_binds(router):
+    # queues holding messages that no consumer is bound to; the check value is how many there are
+    unbound = [(depth, "%s/%s" % (vpn, name)) for vpn, name, depth, backlog, binds in queue_stats(router)
+               if depth and not binds]
+    top = heapq.nlargest(TOP_COUNT, unbound)
+    return top_result("QUEUE-BINDS", "%s queues with messages and no bound consumers, largest" % len(unbound), top,
+                      value=len(unbound))
+
+
+def solace_queue_growth(router):
+    # depth change per -W seconds of every queue since the previous run, from the router's queue store
+    queues = queue_stats(router)
+    now = reply_time(router, QUEUE_DETAIL_RPC)
+    growth = []
+    with CounterStore(state_file(router, "queues"), QUEUE_STATE_SAMPLES) as store:
+        for vpn, name, depth, backlog, binds in queues:
+            rate = store.rate(router.host, vpn, "queue-depth:" + name, float(depth), now, RATE_WINDOW,
+                              monotonic=False)
+            if rate is not None:
+                growth.append((round(rate, 2), "%s/%s" % (vpn, name)))
+    top = heapq.nlargest(TOP_COUNT, growth)
+    return top_result("QUEUE-GROWTH", "Top %s queues by depth growth per %ssec" % (len(top), RATE_WINDOW), top)
+
+
+def metric(rpc, heading, elements, compute='absolute', threshold=None, counter=False, help=''):
+    # elements are (element name, label) pairs; 'percent' combines the two named elements into one value
+    # reported under the first label
+    return {'rpc': rpc, 'heading': heading, 'elements': elements, 'compute': compute, 'threshold': threshold,
+            'counter': counter, 'help': help}
+
+
+def client_metric_pair(heading, var_disp, element_in, element_out, counter=True, help=''):
+    return metric(STATS_CLIENT_RPC, heading, [(element_in, var_disp + "_IN"), (element_out, var_disp + "_OUT")],
+                  counter=counter, help=help)
+
+
+# Every check mode, mapped to the RPC it reads, the elements it reports, how their values are computed
+# ('absolute' element values, 'count' of element occurrences, 'percent' of the first element's value in
+# the second's, or 'rate' per -W seconds) and whether the largest value is compared with -w/-c ('max') or
+# the check is always OK.
+# Modes that cannot be expressed that way name their own check function instead.
+METRICS = collections.OrderedDict([
+    ('SLOW_SUBSCRIBERS', metric(SLOW_SUBSCRIBER_RPC, "SLOW_SUBSCRIBERS", [('client-address', "Slow_Subscribers")],
+                                compute='count', threshold='max', help="Check slow subscriber count")),
+    ('CLIENT-MESSAGES-TOTAL', client_metric_pair("CLIENT_TOTAL_MESSAGES", "Client_Total_Messages",
+                                                 'total-client-messages-received', 'total-client-messages-sent',
+                                                 help="Check total message count")),
+    ('CLIENT-MESSAGES-DATA', client_metric_pair("CLIENT_DATA_MESSAGES", "Client_Data_Messages",
+                                                'client-data-messages-received', 'client-data-messages-sent',
+                                                help="Check data message count")),
+    ('CLIENT-MESSAGES-PERSISTENT', client_metric_pair("CLIENT_PERSISTENT_MESSAGES", "Client_Persistent_Messages",
+                                                      'client-persistent-messages-received',
+                                                      'client-persistent-messages-sent',
+                                                      help="Check persistent message count")),
+    ('CLIENT-MESSAGES-NONPERSISTENT', client_metric_pair("CLIENT_NON_PERSISTENT_MESSAGES",
+                                                         "Client_Non_Persistent_Messages",
+                                                         'client-non-persistent-messages-received',
+                                                         'client-non-persistent-messages-sent',
+                                                         help="Check non-persistent message count")),
+    ('CLIENT-MESSAGES-DIRECT', client_metric_pair("CLIENT_DIRECT_MESSAGES", "Client_Direct_Messages",
+                                                  'client-direct-messages-received', 'client-direct-messages-sent',
+                                                  help="Check direct message count")),
+    ('CLIENT-MESSAGES-CONTROL', client_metric_pair("CLIENT_CONTROL_MESSAGES", "Client_Control_Messages",
+                                                   'client-control-messages-received', 'client-control-messages-sent',
+                                                   help="Check control message count")),
+    ('CLIENT-MESSAGES-RATE', client_metric_pair("MESSAGE_RATE_60s", "Message_Rate_60s",
+                                                'average-ingress-rate-per-minute', 'average-egress-rate-per-minute',
+                                                counter=False, help="Check 60-second message rate")),
+    ('CLIENT-BYTES-TOTAL', client_metric_pair("CLIENT_TOTAL_BYTES", "Client_Total_Bytes",
+                                              'total-client-bytes-received', 'total-client-bytes-sent',
+                                              help="Check total message bytes")),
+    ('CLIENT-BYTES-DATA', client_metric_pair("CLIENT_DATA_BYTES", "Client_Data_Bytes",
+                                             'client-data-bytes-received', 'client-data-bytes-sent',
+                                             help="Check data message bytes")),
+    ('CLIENT-BYTES-PERSISTENT', client_metric_pair("CLIENT_PERSISTENT_BYTES", "Client_Persistent_Bytes",
+                                                   'client-persistent-bytes-received', 'client-persistent-bytes-sent',
+                                                   help="Check persistent message bytes")),
+    ('CLIENT-BYTES-NONPERSISTENT', client_metric_pair("CLIENT_NON_PERSISTENT_BYTES", "Client_Non_Persistent_Bytes",
+                                                      'client-non-persistent-bytes-received',
+                                                      'client-non-persistent-bytes-sent',
+                                                      help="Check non-persistent message bytes")),
+    ('CLIENT-BYTES-DIRECT', client_metric_pair("CLIENT_DIRECT_BYTES", "Client_Direct_Bytes",
+                                               'client-direct-bytes-received', 'client-direct-bytes-sent',
+                                               help="Check direct message bytes")),
+    ('CLIENT-BYTES-CONTROL', client_metric_pair("CLIENT_CONTROL_BYTES", "Client_Control_Bytes",
+                                                'client-control-bytes-received', 'client-control-bytes-sent',
+                                                help="Check control message bytes")),
+    ('CLIENT-BYTES-RATE', client_metric_pair("MESSAGE_BYTE_RATE_60s", "Message_Byte_Rate_60s",
+                                             'average-ingress-byte-rate-per-minute',
+                                             'average-egress-byte-rate-per-minute',
+                                             counter=False, help="Check 60-second message bandwidth")),
+    ('DISCARDS', metric(STATS_CLIENT_RPC, "DISCARDS", [('total-ingress-discards', "Ingress_Discards"),
+                                                       ('total-egress-discards', "Egress_Discards")],
+                        counter=True, help="Check ingress/egress discards")),
+    ('DISCARD-RATE', metric(STATS_CLIENT_RPC, "DISCARD-RATE", [('total-ingress-discards', "Ingress_Discards_Rate"),
+                                                               ('total-egress-discards', "Egress_Discards_Rate")],
+                            compute='rate', threshold='max',
+                            help="Calculates ingress/egress discard rate per -W seconds")),
+    ('INGRESS-DISCARDS', metric(STATS_CLIENT_DETAIL_RPC, "INGRESS-DISCARDS",
+                                [('total-ingress-discards', "Total_Ingress_Discards"),
+                                 ('no-subscription-match', "No_Subscription_Match"),
+                                 ('msg-spool-discards', "Msg_Spool_Ingress_Discards"),
+                                 ('message-spool-congestion', "Msg_Spool_Congestion")],
+                                counter=True, help="Checks ingress discards")),
+    ('EGRESS-DISCARDS', metric(STATS_CLIENT_DETAIL_RPC, "EGRESS-DISCARDS",
+                               [('total-egress-discards', "Total_Egress_Discards"),
+                                ('transmit-congestion', "Transmit_Congestion_Discards"),
+                                ('compression-congestion', "Compression_Congestion_Discards"),
+                                ('msg-spool-egress-discards', "Msg_Spool_Egress_Discards")],
+                               counter=True, help="Checks egress discards")),
+    ('SPOOL-UTILIZATION', metric(MESSAGE_SPOOL_RPC, "SPOOL-UTILIZATION",
+                                 [('current-persistent-store-usage', "Spool_Utilization_Percent"),
+                                  ('max-disk-usage', None)],
+                                 compute='percent', threshold='max', help="Checks message spool usage in percent")),
+    ('QUEUE-DEPTH', {'rpc': QUEUE_DETAIL_RPC, 'check': solace_queue_depth,
+                     'help': "Reports the -n queues with the most messages spooled"}),
+    ('QUEUE-BACKLOG', {'rpc': QUEUE_DETAIL_RPC, 'check': solace_queue_backlog,
+                       'help': "Reports the -n queues using the most spool space"}),
+    ('QUEUE-BINDS', {'rpc': QUEUE_DETAIL_RPC, 'check': solace_queue_binds,
+                     'help': "Counts queues holding messages with no consumer bound"}),
+    ('QUEUE-GROWTH', {'rpc': QUEUE_DETAIL_RPC, 'check': solace_queue_growth,
+                      'help': "Reports the -n queues whose depth grew fastest over -W seconds"}),
+    ('TOP-CLIENTS', {'rpc': CLIENT_STATS_RPC, 'check': lambda router: solace_top(router, "TOP-CLIENTS", False),
+                     'help': "Reports the -n clients with the highest -m counters"}),
+    ('TOP-VPNS', {'rpc': CLIENT_STATS_RPC, 'check': lambda router: solace_top(router, "TOP-VPNS", True),
+                  'help': "Reports the -n message VPNs with the highest -m counters"}),
+])
+
+CHECK_MODES = list(METRICS)
+
+# RPCs polled by the collector daemon - every RPC read by a registry-evaluated check
+COLLECTOR_RPCS = list(collections.OrderedDict.fromkeys(entry['rpc'] for entry in METRICS.values()
+                                                       if 'check' not in entry))
+
+
+def metric_readings(router, entry):
+    # (element, label, value) for each value a registry entry reports, before any rate calculation
+    values, counts = semp_extract(router, entry['rpc'])
+    compute = entry['compute']
+    if compute == 'count':
+        readings = [(element, label, counts.get(element, 0)) for element, label in entry['elements']]
+    elif compute == 'percent':
+        (part, label), (whole, _) = entry['elements']
+        total = float(values.get(whole, 0))
+        readings = [(part, label, "%.2f" % (float(values.get(part, 0)) * 100 / total if total else 0))]
+    else:
+        readings = [(element, label, values.get(element, 0)) for element, label in entry['elements']]
+    return readings
+
+
+def evaluate_metric(router, mode):
+    entry = METRICS[mode]
+    if 'check' in entry:
+        return entry['check'](router)
+
+    compute = entry['compute']
+    readings = metric_readings(router, entry)
+    if TREND:
+        return trend_result(router, entry, readings)
+    if HISTORY:
+        record_history(router, readings, reply_time(router, entry['rpc']))
+    if compute == 'rate' or (RATE_MODE and entry['counter']):
+        rates = counter_rates(router, "*", [(element, value) for element, label, value in readings],
+                              reply_time(router, entry['rpc']))
+        if compute == 'rate' and all(rate is None for rate in rates):
+            return entry['heading'], "OK", ("First run - recording counters in %s for rate calculation"
+                                            % state_file(router, "counters"))
+        if compute != 'rate':
+            readings = [(element, "%s_Per_%ssec" % (label, RATE_WINDOW), value)
+                        for element, label, value in readings]
+        readings = [(element, label, format_rate(rate)) for (element, label, value), rate in zip(readings, rates)]
+
     status = "OK"
-    print "INGRESS-DISCARDS", status, "-", "Total_Ingress_Discards = %s No_Subscription_Match = %s " \
-                                   "Msg_Spool_Discards = %s Msg_Spool_Congestion = %s|" \
-                                   "Total_Ingress_Discards=%s;%s;%s;0 No_Subscription_Match=%s;%s;%s;0 " \
-                                   "Msg_Spool_Ingress_Discards=%s;%s;%s;0 Msg_Spool_Congestion=%s;%s;%s;0" % \
-                                   (ingress_discards, no_subscription_match, msg_spool_discards,
-                                    msg_spool_congestion, ingress_discards, WARNING, CRITICAL,
-                                    no_subscription_match, WARNING, CRITICAL, msg_spool_discards,
-                                    WARNING, CRITICAL, msg_spool_congestion, WARNING, CRITICAL)
-
-
-def solace_discard_rate():
-    time_spread = 60  # seconds to average values over
-    ingress_discards = 0
-    egress_discards = 0
-    prev_ingress_discards = 0
-    prev_egress_discards = 0
-    current_time = time.mktime(datetime.now().timetuple())
-    prev_time = None
-    diff_time = None
-    diff_ingress_discards = None
-    diff_egress_discards = None
-    ingress_discards_rate = 0
-    egress_discards_rate = 0
-    prev_ingress_discards_rate = 0
-    prev_egress_discards_rate = 0
-
-    cache_filename = tempfile.gettempdir() + "/check_solace_" + SOLACE_HOST + ".cache"
-    message = "<rpc semp-version='soltr/7_1'><show><stats><client></client></stats></show></rpc>"
-    r = requests.post(call_path, auth=(SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD), data=message)
-    output = minidom.parseString(r.content)
-    if output.getElementsByTagName('client'):
-        ingress_discards = output.getElementsByTagName('total-ingress-discards')[0].firstChild.nodeValue
-        egress_discards = output.getElementsByTagName('total-egress-discards')[0].firstChild.nodeValue
-
-    # read previous values from cache file
-    if os.path.isfile(cache_filename):
-        # cache file exists - read data
-        cache_file = open(cache_filename, 'r+')
-        prev_time = cache_file.readline().rstrip('\n')
-        prev_ingress_discards = cache_file.readline().rstrip('\n')
-        prev_egress_discards = cache_file.readline().rstrip('\n')
-        prev_ingress_discards_rate = cache_file.readline().rstrip('\n')
-        prev_egress_discards_rate = cache_file.readline().rstrip('\n')
-
-        # calculate difference stats
-        diff_time = float(current_time) - float(prev_time)
-        diff_ingress_discards = float(ingress_discards) - float(prev_ingress_discards)
-        diff_egress_discards = float(egress_discards) - float(prev_egress_discards)
-        ingress_discards_rate = diff_ingress_discards / (diff_time / time_spread)
-        egress_discards_rate = diff_egress_discards / (diff_time / time_spread)
-
-        # require time_spread seconds to pass before calculating stats
-        if diff_time < time_spread:
-            ingress_discards_rate = prev_ingress_discards_rate
-            egress_discards_rate = prev_egress_discards_rate
-        else:
-            # delete the contents of the cache file and write new values
-            cache_file.seek(0)
-            cache_file.truncate()
-            cache_file.write(str(current_time) + "\n")
-            cache_file.write(str(ingress_discards) + "\n")
-            cache_file.write(str(egress_discards) + "\n")
-            cache_file.write(str(ingress_discards_rate) + "\n")
-            cache_file.write(str(egress_discards_rate) + "\n")
-            cache_file.close()
-
-        status = "OK"
-        if float(ingress_discards_rate) >= float(CRITICAL) or float(egress_discards_rate) >= float(CRITICAL):
+    if entry['threshold'] == 'max':
+        numbers = [float(value) for element, label, value in readings if value != "U"]
+        if numbers and max(numbers) >= float(CRITICAL):
             status = "Critical"
-        elif float(ingress_discards_rate) >= float(WARNING) or float(egress_discards_rate) >= float(WARNING):
+        elif numbers and max(numbers) >= float(WARNING):
             status = "Warning"
-        print "DISCARD-RATE", status, "-", "Ingress_Discards/%ssec=%s Egress_Discards/%ssec=%s|" \
-                                           "Ingress_Discards_Rate=%s;%s;%s;0 Egress_Discards_Rate=%s;%s;%s;0" % \
-                                           (time_spread, ingress_discards_rate, time_spread, egress_discards_rate,
-                                            ingress_discards_rate, WARNING, CRITICAL,
-                                            egress_discards_rate, WARNING, CRITICAL)
-    else:
-        # cache file doesn't exist - create file and write stats
-        cache_file = open(cache_filename, 'w')
-        cache_file.write(str(current_time) + "\n")
-        cache_file.write(str(ingress_discards) + "\n")
-        cache_file.write(str(egress_discards) + "\n")
-        cache_file.write(str(ingress_discards_rate) + "\n")
-        cache_file.write(str(egress_discards_rate) + "\n")
-        cache_file.close()
-        print "First run - creating cache file", cache_filename, "for discard rate calculation"
-        return
-
-
-def solace_client_in_out(sempvar_in, sempvar_out, heading, var_disp):
-    data_in = 0
-    data_out = 0
-    message = "<rpc semp-version='soltr/7_1'><show><stats><client></client></stats></show></rpc>"
-    r = requests.post(call_path, auth=(SOLACE_CLI_USERNAME, SOLACE_CLI_PASSWORD), data=message)
-    output = minidom.parseString(r.content)
-    if output.getElementsByTagName('client'):
-        data_in = output.getElementsByTagName(sempvar_in)[0].firstChild.nodeValue
-        data_out = output.getElementsByTagName(sempvar_out)[0].firstChild.nodeValue
-    status = "OK"
-    print heading, status, "-", "%s_IN = %s %s_OUT = %s|%s_IN=%s;%s;%s;0 " \
-                                   "%s_OUT=%s;%s;%s;0" \
-                                   % (var_disp, data_in, var_disp, data_out, var_disp, data_in, WARNING, CRITICAL,
-                                      var_disp, data_out, WARNING, CRITICAL)
+    message = " ".join("%s = %s" % (label, value) for element, label, value in readings)
+    perfdata = " ".join("%s=%s;%s;%s;0" % (label, value, WARNING, CRITICAL) for element, label, value in readings)
+    return entry['heading'], status, "%s|%s" % (message, perfdata)
+
+
+def run_checks(router, modes):
+    # semp_extract keeps each reply for the rest of the run, so metrics sharing an RPC are all evaluated
+    # from a single request. A check that fails reports Unknown on its own; checks sharing an RPC that
+    # failed reuse its error instead of sending it again.
+    results = []
+    failed = {}
+    for mode in modes:
+        rpc = METRICS[mode]['rpc']
+        try:
+            if rpc in failed:
+                raise failed[rpc]
+            heading, status, output = evaluate_metric(router, mode)
+        except (requests.RequestException, SyntaxError) as e:
+            failed[rpc] = e
+            results.append((mode, "Unknown", "SEMP request to %s failed: %s" % (router.host, e)))
+            continue
+        except Exception as e:
+            results.append((mode, "Unknown", "%s check failed: %s" % (mode, e)))
+            continue
+        if PROFILE:
+            # combined results share one perfdata string, so their timing labels name the check
+            timing = profile_perfdata(router, mode, mode + "_" if COMBINED else "")
+            if timing:
+                output = "%s%s%s" % (output, " " if "|" in output else "|", timing)
+        results.append((heading, status, output))
+    return results
+
+
+def prometheus_labels(labels):
+    return ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in labels)
+
+
+def scrape_router(router):
+    # (name, type, labels, value) samples for one router: every registry value that is not a rate (Prometheus
+    # derives those itself), then the per-client counters summed by message VPN
+    router.replies = {}
+    samples = []
+    started = time.time()
+    try:
+        seen = set()
+        for entry in METRICS.values():
+            if 'check' in entry or entry['compute'] == 'rate':
+                continue
+            for element, label, value in metric_readings(router, entry):
+                if element in seen:
+                    continue
+                seen.add(element)
+                if element in DISCARD_LABELS:
+                    direction, reason = DISCARD_LABELS[element]
+                    samples.append(("solace_discards_total", 'counter',
+                                    [('router', router.host), ('direction', direction), ('reason', reason)], value))
+                elif entry['counter']:
+                    # OpenMetrics requires counter names to end in _total
+                    samples.append(("solace_" + label.lower() + "_total", 'counter', [('router', router.host)], value))
+                else:
+                    samples.append(("solace_" + label.lower(), 'gauge', [('router', router.host)], value))
+
+        vpns = {}
+        for record in router.records(CLIENT_STATS_RPC, 'client'):
+            totals = vpns.setdefault(record.get('message-vpn', ''), [0] * (len(VPN_COUNTERS) + 1))
+            totals[-1] += 1
+            for i, element in enumerate(VPN_COUNTERS):
+                try:
+                    totals[i] += int(record.get(element, 0))
+                except ValueError:
+                    pass
+        for vpn, totals in sorted(vpns.items()):
+            labels = [('router', router.host), ('vpn', vpn)]
+            for element, total in zip(VPN_COUNTERS, totals):
+                samples.append(("solace_vpn_" + element.replace('-', '_'), 'gauge', labels, total))
+            samples.append(("solace_vpn_clients", 'gauge', labels, totals[-1]))
+        up = 1
+    except Exception as e:
+        # one failing router reports solace_up 0 rather than failing the whole page
+        sys.stderr.write("Scraping %s failed: %s\n" % (router.host, e))
+        samples = []
+        up = 0
+    samples.append(("solace_up", 'gauge', [('router', router.host)], up))
+    samples.append(("solace_scrape_duration_seconds", 'gauge', [('router', router.host)],
+                    "%.3f" % (time.time() - started)))
+    return samples
+
+
+def render_metrics(routers, pool):
+    # Prometheus text exposition of every router, scraped concurrently; samples are grouped by metric name
+    # with a single TYPE line each
+    families = collections.OrderedDict()
+    for samples in pool.map(scrape_router, routers):
+        for name, metric_type, labels, value in samples:
+            families.setdefault((name, metric_type), []).append((labels, value))
+    lines = []
+    for (name, metric_type), samples in families.items():
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for labels, value in samples:
+            lines.append("%s{%s} %s" % (name, prometheus_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+class ExporterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExporterServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listen, hosts):
+        BaseHTTPServer.HTTPServer.__init__(self, listen, ExporterHandler)
+        # routers live for the whole run so their keep-alive sessions are reused from scrape to scrape
+        self.routers = [SempRouter(host) for host in hosts]
+        self.pool = ThreadPool(min(WORKERS, len(hosts)))
+        self.lock = threading.Lock()
+        self.rendered = None
+        self.rendered_time = 0
+
+    def metrics(self):
+        # scrapes arriving while another one is polling wait for it and share its result
+        with self.lock:
+            if time.time() - self.rendered_time >= SCRAPE_CACHE_TTL:
+                self.rendered = render_metrics(self.routers, self.pool)
+                self.rendered_time = time.time()
+            return self.rendered
+
+
+def run_exporter(hosts, listen):
+    ExporterServer(listen, hosts).serve_forever()
 
 
 if __name__ == '__main__':
-    SOLACE_HOST = None
+    SOLACE_HOSTS = []
     SOLACE_CLI_USERNAME = "admin"
     SOLACE_CLI_PASSWORD = "admin"
-    SEMP_PORT = 80
+    SEMP_PORT = None
+    HTTPS = False
+    TLS_VERIFY = True
     SEMP_PATH = "/SEMP"
+    COLLECTOR_SOCKET = None
+    POLL_INTERVAL = 60
+    EXPORTER_LISTEN = ('', 9628)
+    INVENTORY = None
+    WORKERS = 10
+    REQUEST_TIMEOUT = (5, 30)
+    RETRIES = 0
+    RATE_WINDOW = 60
+    TOP_COUNT = 5
+    TOP_METRICS = ['total-ingress-discards', 'total-egress-discards']
+    RESPONSE_CACHE_TTL = 0
+    RESPONSE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "check_solace_replies")
+    STATE_DIR = os.path.join(tempfile.gettempdir(), "check_solace_state")
+    HISTORY_DIR = os.path.join(tempfile.gettempdir(), "check_solace_history")
+    TREND_RANGE = 3600
+    TREND_STATISTIC = 'avg'
+
+    MODES, CRITICAL, WARNING = parse_options()
+
+    if INVENTORY is not None:
+        SOLACE_HOSTS.extend(read_inventory(INVENTORY))
 
-    MODE, CRITICAL, WARNING = parse_options()
+    if COLLECTOR:
+        if not SOLACE_HOSTS or COLLECTOR_SOCKET is None:
+            sys.stderr.write(display_help())
+            sys.exit(3)
+        run_collector(SOLACE_HOSTS, COLLECTOR_SOCKET, POLL_INTERVAL)
+        sys.exit(0)
 
-    if (SOLACE_HOST is None) or (MODE is None) or (WARNING is None) or (CRITICAL is None):
+    if EXPORTER:
+        if not SOLACE_HOSTS:
+            sys.stderr.write(display_help())
+            sys.exit(3)
+        run_exporter(SOLACE_HOSTS, EXPORTER_LISTEN)
+        sys.exit(0)
+
+    if (not SOLACE_HOSTS) or (not MODES) or (WARNING is None) or (CRITICAL is None):
         sys.stderr.write(display_help())
         sys.exit(3)
 
-    call_path = "http://" + SOLACE_HOST + ":" + str(SEMP_PORT) + SEMP_PATH
-    if MODE == "SLOW_SUBSCRIBERS":
-        solace_slow_subscribers()
-    if MODE == "DISCARDS":
-        solace_discards()
-    if MODE == "DISCARD-RATE":
-        solace_discard_rate()
-    if MODE == "EGRESS-DISCARDS":
-        solace_egress_discards()
-    if MODE == "INGRESS-DISCARDS":
-        solace_ingress_discards()
-    if MODE == "CLIENT-MESSAGES-TOTAL":
-        solace_client_in_out('total-client-messages-received', 'total-client-messages-sent', "CLIENT_TOTAL_MESSAGES", "Client_Total_Messages")
-    if MODE == "CLIENT-MESSAGES-DATA":
-        solace_client_in_out('client-data-messages-received', 'client-data-messages-sent', "CLIENT_DATA_MESSAGES", "Client_Data_Messages")
-    if MODE == "CLIENT-MESSAGES-PERSISTENT":
-        solace_client_in_out('client-persistent-messages-received', 'client-persistent-messages-sent', "CLIENT_PERSISTENT_MESSAGES", "Client_Persistent_Messages")
-    if MODE == "CLIENT-MESSAGES-NONPERSISTENT":
-        solace_client_in_out('client-non-persistent-messages-received', 'client-non-persistent-messages-sent', "CLIENT_NON_PERSISTENT_MESSAGES", "Client_Non_Persistent_Messages")
-    if MODE == "CLIENT-MESSAGES-DIRECT":
-        solace_client_in_out('client-direct-messages-received', 'client-direct-messages-sent', "CLIENT_DIRECT_MESSAGES", "Client_Direct_Messages")
-    if MODE == "CLIENT-MESSAGES-CONTROL":
-        solace_client_in_out('client-control-messages-received', 'client-control-messages-sent', "CLIENT_CONTROL_MESSAGES", "Client_Control_Messages")
-    if MODE == "CLIENT-MESSAGES-RATE":
-        solace_client_in_out('average-ingress-rate-per-minute', 'average-egress-rate-per-minute', "MESSAGE_RATE_60s", "Message_Rate_60s")
-    if MODE == "CLIENT-BYTES-TOTAL":
-        solace_client_in_out('total-client-bytes-received', 'total-client-bytes-sent', "CLIENT_TOTAL_BYTES", "Client_Total_Bytes")
-    if MODE == "CLIENT-BYTES-DATA":
-        solace_client_in_out('client-data-bytes-received', 'client-data-bytes-sent', "CLIENT_DATA_BYTES", "Client_Data_Bytes")
-    if MODE == "CLIENT-BYTES-PERSISTENT":
-        solace_client_in_out('client-persistent-bytes-received', 'client-persistent-bytes-sent', "CLIENT_PERSISTENT_BYTES", "Client_Persistent_Bytes")
-    if MODE == "CLIENT-BYTES-NONPERSISTENT":
-        solace_client_in_out('client-non-persistent-bytes-received', 'client-non-persistent-bytes-sent', "CLIENT_NON_PERSISTENT_BYTES", "Client_Non_Persistent_Bytes")
-    if MODE == "CLIENT-BYTES-DIRECT":
-        solace_client_in_out('client-direct-bytes-received', 'client-direct-bytes-sent', "CLIENT_DIRECT_BYTES", "Client_Direct_Bytes")
-    if MODE == "CLIENT-BYTES-CONTROL":
-        solace_client_in_out('client-control-bytes-received', 'client-control-bytes-sent', "CLIENT_CONTROL_BYTES", "Client_Control_Bytes")
-    if MODE == "CLIENT-BYTES-RATE":
-        solace_client_in_out('average-ingress-byte-rate-per-minute', 'average-egress-byte-rate-per-minute', "MESSAGE_BYTE_RATE_60s", "Message_Byte_Rate_60s")
+    # Nagios reads the status from the exit code, so the run exits with the worst status of any check
+    statuses = []
+    if len(SOLACE_HOSTS) == 1:
+        host, results, router = poll_host(SOLACE_HOSTS[0])
+        statuses.extend(status for heading, status, output in results)
+        if JSON_OUTPUT:
+            print format_json(host, results, router)
+        else:
+            for result in results:
+                print format_result(result)
+    else:
+        # every router is polled on its own worker thread, so the run takes about as long as the slowest router
+        pool = ThreadPool(min(WORKERS, len(SOLACE_HOSTS)))
+        for host, results, router in pool.imap(poll_host, SOLACE_HOSTS):
+            statuses.extend(status for heading, status, output in results)
+            if JSON_OUTPUT:
+                print format_json(host, results, router)
+            else:
+                for result in results:
+                    print host, format_result(result)
+        pool.close()
+    sys.exit(EXIT_CODES[worst_status(statuses)])
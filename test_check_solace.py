@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+test_check_solace - Unit tests for check_solace's counter rates, history rings and reply paging
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from xml.etree import cElementTree as ElementTree
+
+import check_solace
+from benchmark import FakeSempServer
+
+
+class CounterStoreTest(unittest.TestCase):
+    # rate() only works on the in-memory samples, so the store is used without loading or saving its file
+    def setUp(self):
+        self.store = check_solace.CounterStore(os.devnull)
+
+    def rate(self, value, now, window=60, monotonic=True):
+        return self.store.rate("router", "vpn", "metric", value, now, window, monotonic)
+
+    def test_first_sample_has_no_rate(self):
+        self.assertIsNone(self.rate(100, 1000))
+
+    def test_rate_per_window(self):
+        self.rate(100, 1000)
+        self.assertEqual(self.rate(130, 1030), 60)
+
+    def test_base_is_newest_sample_at_least_window_old(self):
+        for now, value in ((0, 0), (30, 100), (60, 130)):
+            self.rate(value, now)
+        # measured from the sample at 30, not the oldest one at 0
+        self.assertEqual(self.rate(160, 90), 60)
+
+    def test_oldest_sample_is_base_until_window_is_covered(self):
+        self.rate(0, 0)
+        self.rate(5, 5)
+        self.assertEqual(self.rate(10, 10), 60)
+
+    def test_counter_reset_starts_again(self):
+        self.rate(1000, 0)
+        self.rate(1060, 60)
+        self.assertIsNone(self.rate(10, 120))
+        self.assertEqual(self.rate(40, 150), 60)
+
+    def test_gauge_decrease_is_negative_rate(self):
+        self.rate(100, 0, monotonic=False)
+        self.assertEqual(self.rate(70, 60, monotonic=False), -30)
+
+    def test_same_reply_is_measured_again(self):
+        self.rate(100, 0)
+        self.assertEqual(self.rate(160, 60), 60)
+        self.assertEqual(self.rate(160, 60), 60)
+        self.assertEqual(len(self.store.counters["router\tvpn\tmetric"]), 2)
+
+    def test_older_reply_is_ignored(self):
+        self.rate(100, 0)
+        self.rate(160, 60)
+        self.assertIsNone(self.rate(130, 30))
+        self.assertEqual(self.store.counters["router\tvpn\tmetric"][-1], [60, 160])
+
+    def test_samples_are_capped(self):
+        self.store.samples = 3
+        for now in range(0, 600, 60):
+            self.rate(now, now)
+        self.assertEqual([sample[0] for sample in self.store.counters["router\tvpn\tmetric"]], [420, 480, 540])
+
+
+class HistoryRingTest(unittest.TestCase):
+    # a small layout of two series of four samples, so wraparound and eviction are quick to reach
+    def setUp(self):
+        self.layout = check_solace.HISTORY_SERIES, check_solace.HISTORY_SAMPLES
+        check_solace.HISTORY_SERIES, check_solace.HISTORY_SAMPLES = 2, 4
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "router.ring")
+
+    def tearDown(self):
+        check_solace.HISTORY_SERIES, check_solace.HISTORY_SAMPLES = self.layout
+        shutil.rmtree(self.directory)
+
+    def test_samples_in_time_order(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            for now in range(1, 4):
+                history.append("a", now, now * 10)
+            self.assertEqual(history.samples("a", 0), [(1, 10), (2, 20), (3, 30)])
+
+    def test_wraparound_keeps_newest_samples(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            for now in range(1, 11):
+                history.append("a", now, now * 10)
+            self.assertEqual(history.samples("a", 0), [(7, 70), (8, 80), (9, 90), (10, 100)])
+
+    def test_samples_since(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            for now in range(1, 7):
+                history.append("a", now, now)
+            # the ring has wrapped, so the search runs over positions that start mid-ring
+            self.assertEqual(history.samples("a", 4.5), [(5, 5), (6, 6)])
+            self.assertEqual(history.samples("a", 5), [(5, 5), (6, 6)])
+            self.assertEqual(history.samples("a", 3), [(3, 3), (4, 4), (5, 5), (6, 6)])
+            self.assertEqual(history.samples("a", 7), [])
+            self.assertEqual(history.samples("b", 0), [])
+
+    def test_older_time_is_ignored(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            history.append("a", 5, 1)
+            history.append("a", 5, 2)
+            history.append("a", 3, 3)
+            self.assertEqual(history.samples("a", 0), [(5, 1)])
+
+    def test_least_recently_updated_series_is_evicted(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            history.append("a", 10, 1)
+            history.append("b", 5, 2)
+            history.append("c", 20, 3)
+            self.assertEqual(history.samples("a", 0), [(10, 1)])
+            self.assertEqual(history.samples("b", 0), [])
+            self.assertEqual(history.samples("c", 0), [(20, 3)])
+
+    def test_samples_survive_reopening(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            history.append("a", 1, 1)
+        with check_solace.HistoryRing(self.filename) as history:
+            self.assertEqual(history.samples("a", 0), [(1, 1)])
+
+    def test_other_layout_starts_empty(self):
+        with check_solace.HistoryRing(self.filename) as history:
+            history.append("a", 1, 1)
+        check_solace.HISTORY_SAMPLES = 8
+        with check_solace.HistoryRing(self.filename) as history:
+            self.assertEqual(history.samples("a", 0), [])
+
+
+class IterRecordsTest(unittest.TestCase):
+    def records(self, reply, record_tag):
+        events = ElementTree.iterparse(StringIO(reply), events=('start', 'end'))
+        return list(check_solace.iter_records(events, record_tag))
+
+    def test_records_with_leaf_values(self):
+        reply = "<rpc-reply><show><client><primary-virtual-router>" \
+                "<client><name> one </name><stats><sent>1</sent><received>2</received></stats></client>" \
+                "<client><name>two</name><stats><sent>3</sent></stats><sent>4</sent></client>" \
+                "</primary-virtual-router></client></show></rpc-reply>"
+        self.assertEqual(self.records(reply, 'client'), [{'name': 'one', 'sent': '1', 'received': '2'},
+                                                         {'name': 'two', 'sent': '3'}])
+
+    def test_elements_without_name_are_not_records(self):
+        reply = "<rpc-reply><show><client><count>2</count></client></show></rpc-reply>"
+        self.assertEqual(self.records(reply, 'client'), [])
+
+
+class PagingTest(unittest.TestCase):
+    # SempRouter against the benchmark's fake router, replying with pages of ten clients
+    def setUp(self):
+        self.server = FakeSempServer(25, page_size=10)
+        self.server.start()
+        self.settings = dict((name, getattr(check_solace, name, None))
+                             for name in ('SEMP_PORT', 'HTTPS', 'TLS_VERIFY', 'SEMP_PATH', 'SOLACE_CLI_USERNAME',
+                                          'SOLACE_CLI_PASSWORD', 'REQUEST_TIMEOUT', 'RETRIES',
+                                          'RESPONSE_CACHE_TTL', 'PROFILE'))
+        check_solace.SEMP_PORT = self.server.server_port
+        check_solace.HTTPS = False
+        check_solace.TLS_VERIFY = True
+        check_solace.SEMP_PATH = "/SEMP"
+        check_solace.SOLACE_CLI_USERNAME = "admin"
+        check_solace.SOLACE_CLI_PASSWORD = "admin"
+        check_solace.REQUEST_TIMEOUT = (5, 30)
+        check_solace.RETRIES = 0
+        check_solace.RESPONSE_CACHE_TTL = 0
+        check_solace.PROFILE = False
+        self.router = check_solace.SempRouter("127.0.0.1")
+
+    def tearDown(self):
+        self.router.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        for name, value in self.settings.items():
+            setattr(check_solace, name, value)
+
+    def test_more_cookie_is_followed_to_last_page(self):
+        records = list(self.router.records(check_solace.CLIENT_STATS_RPC, 'client'))
+        self.assertEqual([record['name'] for record in records], ["client-%s" % i for i in range(25)])
+        self.assertEqual(records[3]['total-ingress-discards'], "15")
+        self.assertEqual(self.server.requests, 3)
+
+    def test_prefetched_records(self):
+        records = list(self.router.records(check_solace.CLIENT_STATS_RPC, 'client', prefetch=True))
+        self.assertEqual(len(records), 25)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_cookie_elements_are_not_passed_on(self):
+        values, counts = self.router.extract(check_solace.CLIENT_STATS_RPC)
+        # 25 clients and the <client> wrapping each of the three pages; the RPCs in the two cookies are skipped
+        self.assertEqual(counts['client'], 28)
+        self.assertNotIn('more-cookie', counts)
+        self.assertNotIn('bench-page', counts)
+
+
+if __name__ == '__main__':
+    unittest.main()